@@ -34,6 +34,32 @@ class TestFacebook(ProviderTestCase):
         expected = {'facebook:likes': 16, 'facebook:shares': 1}
         assert_equals(metrics_dict, expected)
 
+    def test_extract_metrics_for_ids(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        good_page = f.read()
+        metrics_by_id = self.provider._extract_metrics_for_ids(good_page)
+        expected = {TEST_ID: {'facebook:likes': 16, 'facebook:shares': 1}}
+        assert_equals(metrics_by_id, expected)
+
+    def test_extract_metrics_for_ids_matches_by_position(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        good_page = f.read()
+        # facebook can return a different form of the url than was asked for
+        metrics_by_id = self.provider._extract_metrics_for_ids(good_page, ids=["http://total-impact.org/"])
+        expected = {"http://total-impact.org/": {'facebook:likes': 16, 'facebook:shares': 1}}
+        assert_equals(metrics_by_id, expected)
+
+    def test_extract_metrics_for_ids_matches_by_normalized_url(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        good_page = f.read()
+        metrics_by_id = self.provider._extract_metrics_for_ids(good_page, 
+            ids=["http://example.com", "https://WWW.total-impact.org/"])
+        expected = {"https://WWW.total-impact.org/": {'facebook:likes': 16, 'facebook:shares': 1}}
+        assert_equals(metrics_by_id, expected)
+
+    def test_provides_metrics_batch(self):
+        assert_equals(self.provider.provides_metrics_batch, True)
+
     def test_provenance_url(self):
         provenance_url = self.provider.provenance_url("tweets", 
             [self.testitem_aliases])
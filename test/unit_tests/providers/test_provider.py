@@ -4,7 +4,7 @@ from nose.tools import assert_equals, nottest
 from xml.dom import minidom 
 
 import simplejson, BeautifulSoup
-import os
+import os, threading, time
 
 sampledir = os.path.join(os.path.split(__file__)[0], "../../../extras/sample_provider_pages/")
 
@@ -45,6 +45,22 @@ class Test_Provider():
         provider_names = [provider.__class__.__name__ for provider in providers]
         assert_equals(set(provider_names), set(['Pubmed']))
 
+    def test_get_registry_is_built_once(self):
+        registry = ProviderFactory.get_registry(self.TEST_PROVIDER_CONFIG)
+        assert registry is ProviderFactory.get_registry(self.TEST_PROVIDER_CONFIG)
+        assert registry is not ProviderFactory.get_registry([("wikipedia", {})])
+
+    def test_registry_capabilities(self):
+        registry = ProviderFactory.get_registry(self.TEST_PROVIDER_CONFIG)
+        assert_equals(registry.get_provider_names(), ["pubmed", "wikipedia", "mendeley"])
+        assert_equals(registry.get_provider_names("biblio"), ["pubmed"])
+        assert_equals(registry.num_providers("metrics"), 3)
+        assert_equals(registry.get_provider("wikipedia").__class__.__name__, "Wikipedia")
+        assert "wikipedia:mentions" in registry.get_metric_names()
+
+    def test_num_providers_with_metrics(self):
+        assert_equals(ProviderFactory.num_providers_with_metrics(self.TEST_PROVIDER_CONFIG), 3)
+
     def test_lookup_json(self):
         page = self.TEST_JSON
         data = simplejson.loads(page)
@@ -80,12 +96,202 @@ class Test_Provider():
         response = provider._extract_from_xml(page, dict_of_keylists)
         assert_equals(response, {'count': 17})
 
+    def test_get_http_session_is_per_thread_with_shared_pool(self):
+        session = provider.get_http_session("pubmed")
+        assert_equals(provider.get_http_session("pubmed") is session, True)
+        assert_equals(provider.get_http_session("crossref") is session, False)
+
+        other_thread_sessions = []
+        t = threading.Thread(target=lambda: other_thread_sessions.append(provider.get_http_session("pubmed")))
+        t.start()
+        t.join()
+        assert_equals(other_thread_sessions[0] is session, False)
+        assert_equals(other_thread_sessions[0].poolmanager is session.poolmanager, True)
+        assert_equals(session.config["store_cookies"], False)
+
+    def test_http_session_stats_unknown_provider(self):
+        response = provider.http_session_stats("notaprovider")
+        assert_equals(response, {})
+
+    def test_negative_cache_duration(self):
+        test_provider = ProviderFactory.get_provider("wikipedia")
+        assert_equals(test_provider._negative_cache_duration(404), 60*60*6)
+        assert_equals(test_provider._negative_cache_duration(503), 0)
+
+    def test_negative_cache_duration_transient_4xx_not_cached(self):
+        test_provider = ProviderFactory.get_provider("wikipedia")
+        for status_code in [401, 403, 408, 429]:
+            assert_equals(test_provider._negative_cache_duration(status_code), 0)
+
+    def test_negative_cache_duration_provider_override(self):
+        test_provider = ProviderFactory.get_provider("wikipedia")
+        test_provider.negative_cache_durations = {"4xx": 60}
+        assert_equals(test_provider._negative_cache_duration(404), 60)
+
+    def test_negative_cache_duration_not_longer_than_max_cache_duration(self):
+        test_provider = ProviderFactory.get_provider("wikipedia")
+        test_provider.max_cache_duration = 10
+        assert_equals(test_provider._negative_cache_duration(404), 10)
+
     def test_doi_from_url_string(self):
         test_url = "https://knb.ecoinformatics.org/knb/d1/mn/v1/object/doi:10.5063%2FAA%2Fnrs.373.1"
         expected = "10.5063/AA/nrs.373.1"
         response = provider.doi_from_url_string(test_url)
         assert_equals(response, expected)
 
+class TestInFlightRequests():
+
+    def test_concurrent_calls_share_one_result(self):
+        in_flight = provider.InFlightRequests()
+        release = threading.Event()
+        calls = []
+        def slow_fetch():
+            calls.append(1)
+            release.wait()
+            return "response"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(in_flight.do("key", slow_fetch))) 
+                    for i in range(5)]
+        threads[0].start()
+        while not calls:
+            pass
+        for t in threads[1:]:
+            t.start()
+        time.sleep(0.1)  # let the others start waiting
+        release.set()
+        for t in threads:
+            t.join()
+
+        assert_equals(len(calls), 1)
+        assert_equals(len(results), 5)
+        assert_equals(set(results), set(["response"]))
+        assert_equals(len(in_flight), 0)
+
+    def test_errors_are_raised(self):
+        in_flight = provider.InFlightRequests()
+        def bad_fetch():
+            raise provider.ProviderTimeout("timed out")
+        try:
+            in_flight.do("key", bad_fetch)
+            assert False, "expected ProviderTimeout"
+        except provider.ProviderTimeout:
+            pass
+        assert_equals(len(in_flight), 0)
+
+
+class TestRunConcurrently():
+
+    def test_results_in_order(self):
+        def slow_first():
+            time.sleep(0.1)
+            return "first"
+        results = provider.run_concurrently(slow_first, lambda: "second")
+        assert_equals(results, ["first", "second"])
+
+    def test_calls_overlap(self):
+        def nap():
+            time.sleep(0.2)
+        start = time.time()
+        provider.run_concurrently(nap, nap, nap)
+        assert time.time() - start < 0.5
+
+    def test_extra_threads_take_pool_slots(self):
+        class FakePool(object):
+            def __init__(self, free_slots):
+                self.free_slots = free_slots
+                self.released = 0
+            def try_take_slot(self):
+                if self.free_slots:
+                    self.free_slots -= 1
+                    return True
+                return False
+            def release_slot(self):
+                self.released += 1
+        def nap():
+            time.sleep(0.2)
+            return threading.current_thread()
+        pool = FakePool(1)
+        results = provider.run_concurrently(nap, nap, nap, pool=pool)
+        # one func got a slot of its own, the one that didn't ran on this thread
+        assert_equals(pool.released, 1)
+        assert_equals(results[0], threading.current_thread())
+        assert results[1] != threading.current_thread()
+        assert_equals(results[2], threading.current_thread())
+
+    def test_errors_are_raised(self):
+        def bad_fetch():
+            raise provider.ProviderTimeout("timed out")
+        try:
+            provider.run_concurrently(lambda: "fine", bad_fetch)
+            assert False, "expected ProviderTimeout"
+        except provider.ProviderTimeout:
+            pass
+
+
+class TestProviderHealth():
+
+    def test_opens_after_errors(self):
+        health = provider.ProviderHealth("myprovider", 4, window=4, error_rate=0.5, cooldown=60)
+        for is_error in [False, True, False]:
+            health.record(0.1, is_error)
+        assert_equals(health.state, "closed")
+        health.record(0.1, True)
+        assert_equals(health.state, "open")
+        assert_equals(health.allow_request(), False)
+
+    def test_half_open_after_cooldown(self):
+        health = provider.ProviderHealth("myprovider", 4, window=2, error_rate=0.5, cooldown=0)
+        health.record(0.1, True)
+        health.record(0.1, True)
+        assert_equals(health.state, "open")
+
+        # one trial request gets through
+        assert_equals(health.allow_request(), True)
+        assert_equals(health.state, "half_open")
+        health.record(0.1, False)
+        assert_equals(health.state, "closed")
+        assert_equals(health.allow_request(), True)
+
+    def test_failed_trial_reopens(self):
+        health = provider.ProviderHealth("myprovider", 4, window=1, error_rate=0.5, cooldown=0)
+        health.record(0.1, True)
+        health.allow_request()
+        health.record(0.1, True)
+        assert_equals(health.state, "open")
+
+    def test_concurrency_limit_aimd(self):
+        health = provider.ProviderHealth("myprovider", 8, latency_target=5)
+        assert_equals(health.concurrency_limit(), 8)
+        health.record(0.1, True)
+        assert_equals(health.concurrency_limit(), 4)
+        health.record(10, False)  # too slow
+        assert_equals(health.concurrency_limit(), 2)
+        for i in range(4):
+            health.record(0.1, False)
+        assert_equals(health.concurrency_limit(), 3)
+        for i in range(100):
+            health.record(0.1, False)
+        assert_equals(health.concurrency_limit(), 8)
+
+    def test_publishes_state_changes_per_process(self):
+        class FakeRedis(object):
+            def __init__(self):
+                self.published = []
+            def set_provider_health(self, provider_name, process_name, health):
+                self.published.append((provider_name, process_name, health["state"]))
+        myredis = FakeRedis()
+        health = provider.ProviderHealth("myprovider", 4, myredis, "host:1", window=1, error_rate=0.5, cooldown=60)
+        health.record(0.1, True)
+        assert_equals(myredis.published, [("myprovider", "host:1", "open")])
+
+    def test_state_dict(self):
+        health = provider.ProviderHealth("myprovider", 8)
+        response = health.state_dict()
+        assert_equals(response["state"], "closed")
+        assert_equals(response["concurrency_limit"], 8)
+
+
 class TestProviderFactory():
 
     TEST_PROVIDER_CONFIG = [
@@ -58,6 +58,50 @@ class TestPubmed(ProviderTestCase):
         pmcids = self.provider._extract_citing_pmcids(f.read())
         assert_equals(len(pmcids), 149)
 
+    def test_extract_citing_pmcids_by_pmid(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        pmcids_by_pmid = self.provider._extract_citing_pmcids_by_pmid(f.read())
+        assert_equals(pmcids_by_pmid.keys(), [TEST_PMID])
+        assert_equals(len(pmcids_by_pmid[TEST_PMID]), 149)
+
+    def test_extract_reviewed_by_f1000(self):
+        page = "<Url>http://f1000.com/pubmed/123456</Url>"
+        assert_equals(self.provider._extract_reviewed_by_f1000(page, "123456"), "Yes")
+        assert_equals(self.provider._extract_reviewed_by_f1000(page, "12345"), 0)
+
+    def test_split_pubmed_article_set(self):
+        f = open(SAMPLE_EXTRACT_ALIASES_FROM_PMID_PAGE, "r")
+        pages_by_pmid = self.provider._split_pubmed_article_set(f.read())
+        assert_equals(pages_by_pmid.keys(), ["17593900"])
+        aliases = self.provider._extract_aliases_from_pmid(pages_by_pmid["17593900"], "17593900")
+        assert_equals(aliases, [('doi', u'10.1371/journal.pmed.0040215')])
+
+    def test_provenance_url_uses_filtered_pmids_from_metrics(self):
+        from totalimpact.providers import pubmed
+        pubmed.filtered_pmids_memo.set(("123", "review"), ["456", "789"], 60)
+        # any http call would raise
+        Provider.http_get = common.get_500
+        url = self.provider.provenance_url("pubmed:pmc_citations_reviews", [("pmid", "123")])
+        assert url.startswith("http://www.ncbi.nlm.nih.gov/pubmed?term=456"), url
+        assert "789" in url, url
+
+    def test_get_pmids_for_dois_keeps_esearch_urls_short(self):
+        requested_urls = []
+        def fake_get_eutils_page(id, url, cache_enabled=True):
+            requested_urls.append(url)
+            return ""
+        self.provider._get_eutils_page = fake_get_eutils_page
+
+        dois = ["10.1371/journal.pone.%07i" % i for i in range(self.provider.aliases_batch_size)]
+        response = self.provider._get_pmids_for_dois(dois)
+        assert_equals(response, {})
+        # every doi is searched for, each in a url short enough not to get a 414
+        assert_equals(len(requested_urls), 7)
+        for doi in dois:
+            assert len([url for url in requested_urls if doi in url]) == 1, doi
+        for url in requested_urls:
+            assert len(url) < 2000, len(url)
+
     def test_extract_biblio(self):
         f = open(SAMPLE_EXTRACT_BIBLIO_PAGE, "r")
         ret = self.provider._extract_biblio(f.read())
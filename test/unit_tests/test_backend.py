@@ -1,7 +1,7 @@
-import json, os, Queue, datetime
+import json, os, Queue, datetime, threading, time
 
 from totalimpact import dao, tiredis, backend, default_settings
-from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderFactory
+from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderServerError, ProviderFactory
 from nose.tools import raises, assert_equals, nottest
 from test.utils import slow
 from test import mocks
@@ -63,7 +63,7 @@ class TestProviderWorker(TestBackend):
 
         # test that it put it on the queue
         in_queue = test_couch_queue.pop()
-        expected = ('aaatiid', {'doi': ['10.5061/dryad.3td2f']}, 'aliases')
+        expected = backend.CouchMessage('aaatiid', {'doi': ['10.5061/dryad.3td2f']}, 'aliases')
         assert_equals(in_queue, expected)
 
     def test_add_to_couch_queue_if_nonzero_given_metrics(self):    
@@ -80,7 +80,7 @@ class TestProviderWorker(TestBackend):
 
         # test that it put it on the queue
         in_queue = test_couch_queue.pop()
-        expected = ('aaatiid', metrics_method_response, "metrics")
+        expected = backend.CouchMessage('aaatiid', metrics_method_response, "metrics")
         print in_queue
         assert_equals(in_queue, expected)        
 
@@ -121,6 +121,428 @@ class TestProviderWorker(TestBackend):
         expected = {'url': ['http://somewhere'], 'doi': ['10.1', '10.123']}
         assert_equals(response, expected)
 
+    def test_batch_metrics_wrapper(self):
+        callbacks = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            callbacks.append((tiid, new_content, method_name))
+
+        provider_messages = [
+            backend.ProviderMessage.from_list(["123", {'url': ['http://somewhere']}, "metrics", []]),
+            backend.ProviderMessage.from_list(["456", {'url': ['http://elsewhere']}, "metrics", []])]
+        response = backend.ProviderWorker.batch_wrapper(provider_messages, 
+                mocks.ProviderMock("myfakeprovider"), 
+                "metrics",
+                fake_callback)
+        expected = {'mock:pdf': (1, 'http://drilldownurl.org'), 'mock:html': (2, 'http://drilldownurl.org')}
+        assert_equals(response, [expected, expected])
+        assert_equals(callbacks, [("123", expected, "metrics"), ("456", expected, "metrics")])
+
+    def test_batch_wrapper_aliases(self):
+        callbacks = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            callbacks.append((tiid, aliases_providers_run))
+
+        provider_messages = [
+            backend.ProviderMessage.from_list(["123", {'doi': ['10.123']}, "aliases", []]),
+            backend.ProviderMessage.from_list(["456", {'doi': ['10.456']}, "aliases", []])]
+        response = backend.ProviderWorker.batch_wrapper(provider_messages, 
+                mocks.ProviderMock("myfakeprovider"), 
+                "aliases",
+                fake_callback)
+        expected = [{'doi': ['10.1', '10.123']}, {'doi': ['10.1', '10.456']}]
+        assert_equals(response, expected)
+        assert_equals(callbacks, [("123", ("myfakeprovider",)), ("456", ("myfakeprovider",))])
+        # the messages themselves are unchanged
+        assert_equals(provider_messages[0].aliases_providers_run, ())
+
+    def test_batch_wrapper_retries_one_at_a_time_after_batch_error(self):
+        callbacks = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            callbacks.append((tiid, new_content))
+
+        class BatchFailsProviderMock(mocks.ProviderMock):
+            def metrics_batch(self, list_of_aliases):
+                raise ProviderServerError(None)
+            def metrics(self, aliases, url=None, cache_enabled=True):
+                if ("doi", "10.456") in aliases:
+                    raise ProviderServerError(None)
+                return self.metrics_returns
+
+        provider_messages = [
+            backend.ProviderMessage.from_list(["123", {'doi': ['10.123']}, "metrics", []]),
+            backend.ProviderMessage.from_list(["456", {'doi': ['10.456']}, "metrics", []])]
+        response = backend.ProviderWorker.batch_wrapper(provider_messages, 
+                BatchFailsProviderMock("myfakeprovider"), 
+                "metrics",
+                fake_callback)
+        expected = {'mock:pdf': (1, 'http://drilldownurl.org'), 'mock:html': (2, 'http://drilldownurl.org')}
+        assert_equals(response, [expected, None])
+        assert_equals(callbacks, [("123", expected), ("456", None)])
+
+    def test_call_and_ack_requeues_when_call_fails(self):
+        test_queue = backend.PythonQueue("test_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, None, test_queue, None, None, self.r)
+        provider_message = backend.ProviderMessage("123", {}, "metrics", ())
+        def bad_call():
+            raise ValueError("not a ProviderError")
+        try:
+            provider_worker._call_and_ack([provider_message], bad_call)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+        assert_equals(test_queue.pop_many(10, timeout=0.1), [provider_message])
+
+class TestMessages():
+    def test_from_list_freezes_aliases(self):
+        message = backend.AliasMessage.from_list(["123", {"doi":["10.1"]}, ["pubmed"]])
+        assert_equals(message.tiid, "123")
+        assert_equals(message.aliases, {"doi":("10.1",)})
+        assert_equals(message.aliases_providers_run, ("pubmed",))
+        try:
+            message.aliases["doi"] = ["10.2"]
+            assert False, "expected TypeError"
+        except TypeError:
+            pass
+
+    def test_json_round_trip(self):
+        message = backend.ProviderMessage.from_list(["123", {"doi":["10.1"]}, "metrics", []])
+        message_json = json.dumps(message)
+        assert_equals(json.loads(message_json), ["123", {"doi":["10.1"]}, "metrics", [], "scheduled-refresh", None])
+        assert_equals(backend.ProviderMessage.from_list(json.loads(message_json)), message)
+
+    def test_from_list_keeps_priority(self):
+        message = backend.AliasMessage.from_list(["123", {"doi":["10.1"]}, [], "interactive"])
+        assert_equals(message.priority, "interactive")
+        # lists queued before there were lanes get the default
+        message = backend.CouchMessage.from_list(["123", {"title":"a title"}, "biblio"])
+        assert_equals(message.priority, default_settings.DEFAULT_QUEUE_PRIORITY)
+
+class TestRedisQueue(TestBackend):
+    def test_consumer_name_differs_between_starts(self):
+        name = backend.consumer_name()
+        assert_equals(backend.consumer_name(), name)
+        assert name.startswith(backend.process_name() + ":")
+        # as if this process had been restarted with the same pid
+        start_id = backend.consumer_start_id
+        backend.consumer_start_id = "restarted"
+        try:
+            assert backend.consumer_name() != name
+        finally:
+            backend.consumer_start_id = start_id
+
+    def test_pop_many(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        for tiid in "abcde":
+            queue.push(backend.AliasMessage(tiid, {}, ()))
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["a", "b", "c"])
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["d", "e"])
+        assert_equals(self.r.llen("test_queue:scheduled-refresh"), 0)
+
+    def test_pop_many_empty(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        assert_equals(queue.pop_many(3, timeout=1), [])
+
+    def test_push_many(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        queue.push_many([backend.AliasMessage("a", {}, ()), 
+            backend.AliasMessage("b", {}, (), "interactive"),
+            backend.AliasMessage("c", {}, ())])
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["b"])
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["a", "c"])
+
+    def test_pop_many_takes_most_urgent_lane_first(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        queue.push(backend.AliasMessage("a", {}, (), "scheduled-refresh"))
+        queue.push(backend.AliasMessage("b", {}, (), "scheduled-refresh"))
+        queue.push(backend.AliasMessage("c", {}, (), "interactive"))
+        # a batch never mixes lanes
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["c"])
+        assert_equals([message.tiid for message in queue.pop_many(3)], ["a", "b"])
+
+    def test_ack(self):
+        queue = backend.RedisQueue("test_queue", self.r, consumer="host:1")
+        queue.push(backend.AliasMessage("a", {}, ()))
+        queue.push(backend.AliasMessage("b", {}, ()))
+        messages = queue.pop_many(2)
+        assert_equals(self.r.llen("test_queue:processing:host:1"), 2)
+        queue.ack(messages[:1])
+        assert_equals(self.r.lrange("test_queue:processing:host:1", 0, -1), [json.dumps(messages[1])])
+
+    def test_requeue_abandoned(self):
+        dead_queue = backend.RedisQueue("test_queue", self.r, consumer="deadhost:1")
+        dead_queue.push(backend.AliasMessage("a", {}, (), "interactive"))
+        dead_queue.pop()
+
+        queue = backend.RedisQueue("test_queue", self.r, consumer="livehost:1")
+        # still alive, so left alone
+        self.r.setex(backend.consumer_alive_key("deadhost:1"), "1", 60)
+        queue.requeue_abandoned()
+        assert_equals(queue.pop(timeout=0.1), None)
+
+        self.r.delete(backend.consumer_alive_key("deadhost:1"))
+        queue.requeue_abandoned()
+        message = queue.pop()
+        assert_equals((message.tiid, message.priority), ("a", "interactive"))
+        assert_equals(self.r.llen("test_queue:processing:deadhost:1"), 0)
+        assert_equals(self.r.smembers("test_queue:consumers"), set(["livehost:1"]))
+
+    def test_nack_requeues_then_gives_up(self):
+        queue = backend.RedisQueue("test_queue", self.r, consumer="host:1", max_attempts=2)
+        queue.push(backend.AliasMessage("a", {}, ()))
+        queue.nack([queue.pop()])
+        message = queue.pop()
+        assert_equals(message.tiid, "a")
+        queue.nack([message])
+        assert_equals(queue.pop(timeout=0.1), None)
+        assert_equals(self.r.llen("test_queue:dead"), 1)
+        assert_equals(self.r.llen("test_queue:processing:host:1"), 0)
+        assert_equals(queue.unacked, {})
+
+    def test_nack_calls_on_dead_letter(self):
+        dead_messages = []
+        queue = backend.RedisQueue("test_queue", self.r, consumer="host:1", max_attempts=1, 
+            on_dead_letter=dead_messages.append)
+        queue.push(backend.AliasMessage("a", {}, ()))
+        queue.nack([queue.pop()])
+        assert_equals([message.tiid for message in dead_messages], ["a"])
+
+    def test_decr_num_providers_left_when_dead(self):
+        on_dead_letter = backend.decr_num_providers_left_when_dead(self.r)
+        self.r.set_num_providers_left("a", 2)
+        on_dead_letter(backend.ProviderMessage("a", {}, "biblio", ()))
+        assert_equals(self.r.get_num_providers_left("a"), 2)
+        on_dead_letter(backend.ProviderMessage("a", {}, "metrics", ()))
+        assert_equals(self.r.get_num_providers_left("a"), 1)
+        on_dead_letter(backend.CouchMessage("a", {"wikipedia:mentions":1}, "metrics"))
+        assert_equals(self.r.get_num_providers_left("a"), 0)
+
+    def test_pop_many_wakes_on_push(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        threading.Timer(0.2, queue.push, [backend.AliasMessage("a", {}, ())]).start()
+        start = time.time()
+        messages = queue.pop_many(3, timeout=5)
+        assert_equals([message.tiid for message in messages], ["a"])
+        assert time.time() - start < 1
+
+    def test_pop_pre_lane_messages(self):
+        queue = backend.RedisQueue("test_queue", self.r)
+        self.r.lpush("test_queue", json.dumps(["a", {}, []]))
+        message = queue.pop()
+        assert_equals((message.tiid, message.priority), ("a", default_settings.DEFAULT_QUEUE_PRIORITY))
+
+class TestPythonQueue():
+    def test_pop_many(self):
+        queue = backend.PythonQueue("test_queue")
+        for i in range(5):
+            queue.push([i])
+        assert_equals(queue.pop_many(3), [[0], [1], [2]])
+        assert_equals(queue.pop_many(3), [[3], [4]])
+
+    def test_pop_many_empty(self):
+        queue = backend.PythonQueue("test_queue")
+        assert_equals(queue.pop_many(3, timeout=0.1), [])
+
+    def test_push_many(self):
+        queue = backend.PythonQueue("test_queue")
+        queue.push_many([[0], [1], [2]])
+        assert_equals(queue.pop_many(3), [[0], [1], [2]])
+
+    def test_nack_requeues_then_gives_up(self):
+        queue = backend.PythonQueue("test_queue", max_attempts=2)
+        queue.push([1])
+        queue.nack(queue.pop_many(1))
+        assert_equals(queue.pop_many(1), [[1]])
+        queue.nack([[1]])
+        assert_equals(queue.pop_many(1, timeout=0.1), [])
+
+    def test_nack_calls_on_dead_letter(self):
+        dead_messages = []
+        queue = backend.PythonQueue("test_queue", max_attempts=1, on_dead_letter=dead_messages.append)
+        queue.push([1])
+        queue.nack(queue.pop_many(1))
+        assert_equals(dead_messages, [[1]])
+
+    def test_pop_by_priority_then_arrival(self):
+        queue = backend.PythonQueue("test_queue")
+        queue.push(backend.CouchMessage("a", {}, "biblio", "scheduled-refresh"))
+        queue.push(backend.CouchMessage("b", {}, "biblio", "collection-create"))
+        queue.push(backend.CouchMessage("c", {}, "biblio", "interactive"))
+        queue.push(backend.CouchMessage("d", {}, "biblio", "collection-create"))
+        assert_equals([message.tiid for message in queue.pop_many(4)], ["c", "b", "d", "a"])
+
+class TestRedisFairQueue(TestBackend):
+    def message(self, tiid, tenant, priority="scheduled-refresh"):
+        return backend.ProviderMessage(tiid, {}, "metrics", (), priority, tenant)
+
+    def test_tenants_take_turns(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={})
+        for i in range(3):
+            queue.push(self.message("big"+str(i), "collection:big"))
+        queue.push(self.message("small0", "collection:small"))
+        queue.push(self.message("other0", None))
+        assert_equals([message.tiid for message in queue.pop_many(10)], 
+            ["big0", "small0", "other0", "big1", "big2"])
+
+    def test_push_many_takes_turns_like_push(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={})
+        queue.push_many([self.message("big0", "collection:big"), 
+            self.message("big1", "collection:big"),
+            self.message("small0", "collection:small"),
+            self.message("interactive", "key:abc", "interactive")])
+        # each tenant joins the ring once
+        assert_equals(self.r.lrange("test_queue:scheduled-refresh:turns", 0, -1), 
+            ["collection:small", "collection:big"])
+        assert_equals([message.tiid for message in queue.pop_many(10)], ["interactive"])
+        assert_equals([message.tiid for message in queue.pop_many(10)], ["big0", "small0", "big1"])
+
+    def test_weights(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={"key:heavy":2})
+        for i in range(3):
+            queue.push(self.message("light"+str(i), "key:light"))
+            queue.push(self.message("heavy"+str(i), "key:heavy"))
+        assert_equals([message.tiid for message in queue.pop_many(10)], 
+            ["light0", "heavy0", "heavy1", "light1", "heavy2", "light2"])
+
+    def test_lanes_before_tenants(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={})
+        queue.push(self.message("refresh", "collection:big"))
+        queue.push(self.message("interactive", "key:abc", "interactive"))
+        assert_equals(queue.pop().tiid, "interactive")
+        assert_equals(queue.pop().tiid, "refresh")
+        assert_equals(queue.pop(timeout=0.1), None)
+
+    def test_pop_many_empty(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={})
+        assert_equals(queue.pop_many(3, timeout=0.1), [])
+
+    def test_tenant_leaves_ring_when_done(self):
+        queue = backend.RedisFairQueue("test_queue", self.r, weights={})
+        queue.push(self.message("a", "collection:small"))
+        queue.pop_many(10)
+        assert_equals(queue.pop(timeout=0.1), None)
+        assert_equals(self.r.llen("test_queue:scheduled-refresh:turns"), 0)
+        # and comes back when it has more
+        queue.push(self.message("b", "collection:small"))
+        assert_equals(queue.pop().tiid, "b")
+
+    def test_requeue_abandoned(self):
+        dead_queue = backend.RedisFairQueue("test_queue", self.r, consumer="deadhost:1", weights={})
+        dead_queue.push(self.message("a", "collection:big"))
+        dead_queue.pop()
+        queue = backend.RedisFairQueue("test_queue", self.r, consumer="livehost:1", weights={})
+        queue.requeue_abandoned()
+        assert_equals(queue.pop().tiid, "a")
+
+class TestWorker():
+    def test_run_in_loop_carries_on_after_errors(self):
+        class FlakyWorker(backend.Worker):
+            name = "flaky"
+            error_backoff_max = 0.01
+            runs = 0
+            def run(self):
+                self.runs += 1
+                if self.runs < 3:
+                    raise Exception("redis went away")
+                # not an Exception, so it gets out of the loop
+                raise KeyboardInterrupt
+        worker = FlakyWorker()
+        try:
+            worker.run_in_loop()
+        except KeyboardInterrupt:
+            pass
+        assert_equals(worker.runs, 3)
+
+class TestProviderThreadPool():
+    def test_submit_runs_tasks_on_fixed_threads(self):
+        pool = backend.ProviderThreadPool("test_pool", 2, 3)
+        done = []
+        def task(i):
+            done.append((i, threading.current_thread().name))
+
+        for i in range(10):
+            pool.submit(task, i)
+        pool.tasks.join()
+
+        assert_equals(sorted([i for (i, thread_name) in done]), range(10))
+        assert_equals(len(pool.threads), 2)
+        assert_equals(set([thread_name for (i, thread_name) in done]) <= set(["test_pool-0", "test_pool-1"]), True)
+
+    def test_backlog_is_bounded(self):
+        pool = backend.ProviderThreadPool("test_pool", 1, 1)
+        release = threading.Event()
+        pool.submit(release.wait)   # occupies the only thread
+        pool.submit(release.wait)   # fills the backlog
+
+        # the backlog is full, so another submit would block
+        assert_equals(pool.tasks.full(), True)
+        release.set()
+        pool.tasks.join()
+        assert_equals(pool.backlog_size(), 0)
+
+    def test_exception_does_not_kill_thread(self):
+        pool = backend.ProviderThreadPool("test_pool", 1, 2)
+        done = []
+        def bad_task():
+            raise ValueError
+        pool.submit(bad_task)
+        pool.submit(done.append, "ok")
+        pool.tasks.join()
+        assert_equals(done, ["ok"])
+        assert_equals(len(pool.threads), 1)
+
+
+    def test_concurrency_follows_provider_health(self):
+        class FakeHealth(object):
+            def concurrency_limit(self):
+                return 1
+        pool = backend.ProviderThreadPool("test_pool", 3, 10, FakeHealth())
+        running = []
+        most_running = []
+        lock = threading.Lock()
+        def task():
+            with lock:
+                running.append(1)
+                most_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        for i in range(6):
+            pool.submit(task)
+        pool.tasks.join()
+        assert_equals(max(most_running), 1)
+        assert_equals(pool.concurrency_limit(), 1)
+
+    def test_backlog_runs_by_priority(self):
+        pool = backend.ProviderThreadPool("test_pool", 1, 10)
+        release = threading.Event()
+        done = []
+        pool.submit(release.wait)   # occupies the only thread while the rest queue up
+        time.sleep(0.01)
+        pool.submit(done.append, "refresh", priority="scheduled-refresh")
+        pool.submit(done.append, "interactive", priority="interactive")
+        release.set()
+        pool.tasks.join()
+        assert_equals(done, ["interactive", "refresh"])
+
+
+class TestProviderPoolSizes():
+    def test_provider_pool_sizes_defaults(self):
+        response = backend.provider_pool_sizes({}, "threads")
+        expected = (default_settings.PROVIDER_WORKER_THREADS, default_settings.PROVIDER_WORKER_BACKLOG)
+        assert_equals(response, expected)
+
+    def test_provider_pool_sizes_gevent(self):
+        response = backend.provider_pool_sizes({}, "gevent")
+        expected = (default_settings.PROVIDER_WORKER_GREENLETS, default_settings.PROVIDER_WORKER_GREENLET_BACKLOG)
+        assert_equals(response, expected)
+
+    def test_provider_pool_sizes_from_provider_config(self):
+        response = backend.provider_pool_sizes({"workers": 2, "backlog": 7}, "gevent")
+        assert_equals(response, (2, 7))
+
+
 class TestCouchWorker(TestBackend):
     def test_update_item_with_new_aliases(self):
         response = backend.CouchWorker.update_item_with_new_aliases(self.fake_aliases_dict, self.fake_item)
@@ -224,9 +646,111 @@ class TestCouchWorker(TestBackend):
         now = datetime.datetime.now().isoformat()
         assert_equals(couch_response["last_modified"][0:10], now[0:10])
 
+    def test_update_item_with_messages(self):
+        couch_messages = [
+            backend.CouchMessage("1", {"doi":["10.5061/dryad.3td2f"]}, "aliases"),
+            backend.CouchMessage("1", {"title":"a title"}, "biblio"),
+            backend.CouchMessage("1", {"pmid":["111"]}, "aliases")]
+        response = backend.CouchWorker.update_item_with_messages(self.fake_item, couch_messages)
+        assert_equals(response["aliases"], {'pmid': ['111'], 'doi': ['10.5061/dryad.3td2f']})
+        assert_equals(response["biblio"], {"title":"a title"})
+
+    def test_update_item_with_messages_no_changes(self):
+        couch_messages = [backend.CouchMessage("1", {"pmid":["111"]}, "aliases")]
+        response = backend.CouchWorker.update_item_with_messages(self.fake_item, couch_messages)
+        assert_equals(response, None)
+
+    def test_run_coalesces_messages_for_same_item(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push(backend.CouchMessage(self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "aliases"))
+        test_couch_queue.push(backend.CouchMessage(self.fake_item["_id"], {"title":"a title"}, "biblio"))
+        self.d.save(self.fake_item)
+        rev_before = self.d.get(self.fake_item["_id"])["_rev"]
+
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.run()
+
+        couch_response = self.d.get(self.fake_item["_id"])
+        assert_equals(couch_response["aliases"], {'pmid': ['111'], 'doi': ['10.5061/dryad.3td2f']})
+        assert_equals(couch_response["biblio"], {"title":"a title"})
+        # both messages went into a single write
+        assert_equals(int(couch_response["_rev"].split("-")[0]), int(rev_before.split("-")[0]) + 1)
+
+    def test_run_acks_saved_messages(self):
+        test_couch_queue = backend.RedisQueue("1_couch_queue", self.r, backend.CouchMessage, consumer="host:1")
+        test_couch_queue.push(backend.CouchMessage(self.fake_item["_id"], {"title":"a title"}, "biblio"))
+        self.d.save(self.fake_item)
+
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.run()
+
+        assert_equals(self.d.get(self.fake_item["_id"])["biblio"], {"title":"a title"})
+        assert_equals(self.r.llen("1_couch_queue:processing:host:1"), 0)
+
+    def test_run_requeues_when_couch_fails(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        couch_message = backend.CouchMessage(self.fake_item["_id"], {"title":"a title"}, "biblio")
+        test_couch_queue.push(couch_message)
+        class BrokenDao(object):
+            def get_many(self, ids):
+                raise IOError("couch is down")
+
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, BrokenDao())
+        couch_worker.run()
+
+        assert_equals(test_couch_queue.pop_many(10, timeout=0.1), [couch_message])
+
+    def test_run_acks_messages_for_missing_items(self):
+        test_couch_queue = backend.RedisQueue("1_couch_queue", self.r, backend.CouchMessage, consumer="host:1")
+        test_couch_queue.push(backend.CouchMessage("notindb", {"title":"a title"}, "biblio"))
+
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.run()
+
+        # couch says it isn't there, so there's no point trying again
+        assert_equals(self.r.llen("1_couch_queue:processing:host:1"), 0)
+        assert_equals(test_couch_queue.pop(timeout=0.1), None)
+
+    def test_save_items_merges_again_after_conflict(self):
+        self.d.save(self.fake_item)
+        stale_item = self.d.get(self.fake_item["_id"])
+
+        # someone else saves the item in the meantime
+        other_copy = self.d.get(self.fake_item["_id"])
+        other_copy["biblio"] = {"title":"a title"}
+        self.d.save(other_copy)
+
+        couch_messages = [backend.CouchMessage(self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "aliases")]
+        updated_item = backend.CouchWorker.update_item_with_messages(stale_item, couch_messages)
+        couch_worker = backend.CouchWorker(backend.PythonQueue("test_couch_queue"), self.r, self.d)
+        couch_worker.save_items([updated_item], {self.fake_item["_id"]: couch_messages})
+
+        # both updates are kept
+        couch_response = self.d.get(self.fake_item["_id"])
+        assert_equals(couch_response["aliases"], {'pmid': ['111'], 'doi': ['10.5061/dryad.3td2f']})
+        assert_equals(couch_response["biblio"], {"title":"a title"})
+
 
 class TestBackendClass(TestBackend):
 
+    def test_route(self):
+        alias_messages = [
+            backend.AliasMessage.from_list(["tiid1", {"url":["http://somewhere"]}, [], "interactive"]), 
+            backend.AliasMessage.from_list(["tiid2", {"unknownnamespace":["111"]}, []])]
+        provider_queues = dict([(provider_name, backend.PythonQueue(provider_name+"_queue")) 
+            for (provider_name, provider_config) in default_settings.PROVIDERS])
+        b = backend.Backend(None, provider_queues, None, self.r)
+        b.route(alias_messages)
+
+        # tiid1 already has urls so goes straight to biblio and metrics, tiid2 needs webpage aliases first
+        wikipedia_messages = provider_queues["wikipedia"].pop_many(10, timeout=0.1)
+        assert_equals([(message.tiid, message.method_name, message.priority) for message in wikipedia_messages], 
+            [("tiid1", "metrics", "interactive")])
+        # the interactive lane comes out first
+        webpage_messages = provider_queues["webpage"].pop_many(10, timeout=0.1)
+        assert_equals([(message.tiid, message.method_name, message.priority) for message in webpage_messages], 
+            [("tiid1", "biblio", "interactive"), ("tiid2", "aliases", "scheduled-refresh")])
+
     def test_decide_who_to_call_next_unknown(self):
         aliases_dict = {"unknownnamespace":["111"]}
         prev_aliases = []
@@ -0,0 +1,71 @@
+from nose.tools import assert_equals
+import time
+
+from totalimpact import cache
+
+
+class TestLruCache():
+
+    def test_get_missing(self):
+        lru = cache.LruCache(2)
+        assert_equals(lru.get("nothere"), None)
+
+    def test_set_and_get(self):
+        lru = cache.LruCache(2)
+        lru.set("a", {"text":"hi"}, 60)
+        assert_equals(lru.get("a"), {"text":"hi"})
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LruCache(2)
+        lru.set("a", 1, 60)
+        lru.set("b", 2, 60)
+        lru.get("a")  # now b is the least recently used
+        lru.set("c", 3, 60)
+        assert_equals(len(lru), 2)
+        assert_equals(lru.get("b"), None)
+        assert_equals(lru.get("a"), 1)
+        assert_equals(lru.get("c"), 3)
+
+    def test_expired_entries_are_not_returned(self):
+        lru = cache.LruCache(2)
+        lru.set("a", 1, 0)
+        assert_equals(lru.get("a"), None)
+        assert_equals(len(lru), 0)
+
+
+class TestCompression():
+
+    def test_small_entries_are_not_compressed(self):
+        data = {"text":"hi", "status_code":200}
+        entry = cache.encode_entry(data, 1000)
+        assert entry.startswith(cache.PICKLED_FORMAT)
+        assert_equals(cache.decode_entry(entry), data)
+
+    def test_large_entries_are_compressed_and_counted(self):
+        data = {"text":"<xml>" + "abc"*5000 + "</xml>", "status_code":200}
+        saved_before = cache.get_cache_stats().get("compressed_bytes_saved", 0)
+        entry = cache.encode_entry(data, 1000)
+        assert entry.startswith(cache.COMPRESSED_FORMAT)
+        assert len(entry) < 1000
+        assert cache.get_cache_stats()["compressed_bytes_saved"] > saved_before + 10000
+        assert_equals(cache.decode_entry(entry), data)
+
+    def test_decode_entries_stored_before_encoding(self):
+        assert_equals(cache.decode_entry(None), None)
+        assert_equals(cache.decode_entry({"text":"hi"}), {"text":"hi"})
+
+
+class TestCache():
+
+    def test_local_cache_age_uses_shorter_max_cache_age(self):
+        c = cache.Cache(max_cache_age=5)
+        assert_equals(c._local_cache_age(), 5)
+
+    def test_get_cache_entry_from_local_tier(self):
+        c = cache.Cache()
+        cache.local_cache.set(c._build_hash_key({"url":"http://local"}), {"text":"hi"}, 60)
+        hits_before = cache.get_cache_stats().get("local_hits", 0)
+
+        response = c.get_cache_entry({"url":"http://local"})
+        assert_equals(response, {"text":"hi"})
+        assert_equals(cache.get_cache_stats()["local_hits"], hits_before + 1)
@@ -74,3 +74,26 @@ class TestDAO(unittest.TestCase):
 
 
              
+
+    def test_get_many(self):
+        self.d.save({"_id":"123", "a":1})
+        self.d.save({"_id":"456", "a":2})
+
+        docs = self.d.get_many(["123", "456", "not_there"])
+        assert_equals(set(docs.keys()), set(["123", "456"]))
+        assert_equals(docs["456"]["a"], 2)
+
+    @raises(AttributeError)
+    def test_get_many_raises_after_retries(self):
+        self.d.db = None
+        self.d.get_many(["123"])
+
+    def test_save_many(self):
+        self.d.save({"_id":"123"})
+        doc = self.d.get("123")
+        doc["a"] = 1
+
+        response = self.d.save_many([doc, {"_id":"456", "a":2}])
+        assert_equals([success for (success, id, rev) in response], [True, True])
+        assert_equals(self.d.get("123")["a"], 1)
+        assert_equals(self.d.get("456")["a"], 2)
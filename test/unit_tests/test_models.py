@@ -251,6 +251,34 @@ class TestItemFactory():
         response = models.ItemFactory.is_currently_updating("tiidthatisdone", self.r)
         assert_equals(response, False)
 
+    def test_are_currently_updating(self):
+        self.r.set_num_providers_left("tiidthatisnotdone", 10)
+        self.r.set_num_providers_left("tiidthatisdone", 0)
+        response = models.ItemFactory.are_currently_updating(
+            ["tiidthatisnotdone", "tiidnotinredis", "tiidthatisdone"], self.r)
+        assert_equals(response, [True, False, False])
+
+    def test_retrieve_items(self):
+        self.d.save(ITEM_DATA)
+        self.r.set_num_providers_left("test", 2)
+        (items, something_currently_updating) = models.ItemFactory.retrieve_items(["test"], 
+            self.myrefsets, self.r, self.d)
+        assert_equals([item["_id"] for item in items], ["test"])
+        assert_equals(items[0]["currently_updating"], True)
+        assert_equals(something_currently_updating, True)
+
+    @raises(LookupError)
+    def test_retrieve_items_missing_item(self):
+        self.d.save(ITEM_DATA)
+        models.ItemFactory.retrieve_items(["test", "notindb"], self.myrefsets, self.r, self.d)
+
+    @raises(IOError)
+    def test_retrieve_items_couch_error_is_not_a_missing_item(self):
+        class BrokenDao(object):
+            def get_many(self, ids):
+                raise IOError("couch is down")
+        models.ItemFactory.retrieve_items(["test"], self.myrefsets, self.r, BrokenDao())
+
     def test_clean_for_export_no_key(self):
         self.d.save(ITEM_DATA)
         item = models.ItemFactory.get_item("test", self.myrefsets, self.d)
@@ -1,6 +1,6 @@
 from nose.tools import raises, assert_equals, nottest
 import redis
-import json
+import json, time
 
 from totalimpact import tiredis
 
@@ -36,6 +36,35 @@ class TestTiRedis():
         num_left = self.r.get_num_providers_left("notinthedatabase")
         assert_equals(None, num_left)
 
+    def test_set_num_providers_left_many(self):
+        self.r.set_num_providers_left_many(["abcd", "efgh"], 11)
+        assert_equals("11", self.r.get("num_providers_left:abcd"))
+        assert_equals(11, self.r.get_num_providers_left("efgh"))
+        assert self.r.ttl("num_providers_left:efgh") > 0
+
+    def test_add_to_alias_queue(self):
+        self.r.add_to_alias_queue("abcd", {"doi":["10.1"]}, priority="interactive")
+        assert_equals(json.loads(self.r.rpop("aliasqueue:interactive")), ["abcd", {"doi":["10.1"]}, [], "interactive", None])
+
+    def test_add_many_to_alias_queue(self):
+        self.r.add_many_to_alias_queue([("abcd", {"doi":["10.1"]}), ("efgh", {"pmid":["111"]})], 
+            priority="collection-create", tenant="collection:123")
+        assert_equals(self.r.llen("aliasqueue:collection-create"), 2)
+        assert_equals(json.loads(self.r.rpop("aliasqueue:collection-create")), 
+            ["abcd", {"doi":["10.1"]}, [], "collection-create", "collection:123"])
+
+    def test_get_num_providers_left_many(self):
+        self.r.set_num_providers_left("abcd", 11)
+        self.r.set_num_providers_left("efgh", 0)
+        num_left = self.r.get_num_providers_left_many(["abcd", "notinthedatabase", "efgh"])
+        assert_equals([11, None, 0], num_left)
+
+    def test_get_currently_updating_many(self):
+        self.r.set_num_providers_left("abcd", 11)
+        self.r.set_num_providers_left("efgh", 0)
+        response = self.r.get_currently_updating_many(["abcd", "notinthedatabase", "efgh"])
+        assert_equals([True, False, False], response)
+
     def test_decr_num_providers_left(self):
         self.r.set_num_providers_left("abcd", 11)
         assert_equals("11", self.r.get("num_providers_left:abcd"))
@@ -63,4 +92,52 @@ class TestTiRedis():
         response = self.r.get_reference_lookup_dict("article", "WoS", 2010)
         assert_equals(response, {"hi":"lookup"})
 
+    def test_provider_health(self):
+        now = time.time()
+        self.r.set_provider_health("myprovider", "host:1", {"state":"closed", "published_at":now})
+        self.r.set_provider_health("myprovider", "host:2", {"state":"open", "published_at":now})
+        self.r.set_provider_health("myprovider", "gonehost:1", {"state":"open", "published_at":now-2*60*60})
+        response = self.r.get_provider_health("myprovider")
+        assert_equals(response, {"host:1": {"state":"closed", "published_at":now}, 
+            "host:2": {"state":"open", "published_at":now}})
+        assert_equals(self.r.get_provider_health("otherprovider"), None)
+
+    def test_server_time(self):
+        assert abs(self.r.server_time() - time.time()) < 60
+
+    def test_server_time_without_time_command(self):
+        class OldRedis(object):
+            def execute_command(self, *args):
+                raise redis.ResponseError("unknown command 'TIME'")
+        try:
+            assert abs(tiredis.server_time(OldRedis()) - time.time()) < 1
+            assert tiredis.server_time_unavailable
+        finally:
+            tiredis.server_time_unavailable = False
+
+    def test_take_rate_limit_token(self):
+        # burst of two, then have to wait for the next token
+        assert_equals(self.r.take_rate_limit_token("myprovider", 1, 2), 0)
+        assert_equals(self.r.take_rate_limit_token("myprovider", 1, 2), 0)
+        wait_seconds = self.r.take_rate_limit_token("myprovider", 1, 2)
+        assert wait_seconds > 0
+        assert wait_seconds <= 1
+
+    def test_take_rate_limit_token_gives_up_when_contended(self):
+        other_redis = tiredis.from_url("redis://localhost:6379", db=8)
+        real_server_time = tiredis.server_time
+        def server_time_with_someone_else_writing(pipe):
+            # change the bucket after it is watched, so every try fails
+            other_redis.hset("rate_limit:myprovider", "tokens", 0)
+            return real_server_time(pipe)
+        tiredis.server_time = server_time_with_someone_else_writing
+        try:
+            wait_seconds = self.r.take_rate_limit_token("myprovider", 1, 2)
+        finally:
+            tiredis.server_time = real_server_time
+        assert wait_seconds > 0
+
+    def test_take_rate_limit_token_buckets_are_separate(self):
+        assert_equals(self.r.take_rate_limit_token("myprovider", 1, 1), 0)
+        assert_equals(self.r.take_rate_limit_token("otherprovider", 1, 1), 0)
 
@@ -1,4 +1,4 @@
-import unittest, json, uuid
+import unittest, json, uuid, time
 from copy import deepcopy
 from urllib import quote_plus
 from nose.tools import assert_equals
@@ -122,6 +122,18 @@ class TestProvider(ViewsTester):
 
 
 
+class TestProviderHealth(ViewsTester):
+
+    def test_provider_health(self):
+        now = time.time()
+        self.r.set_provider_health("pubmed", "host:1", {"state": "open", "published_at": now})
+        resp = self.client.get("/provider/health")
+        assert_equals(resp.status_code, 200)
+        response = json.loads(resp.data)
+        assert_equals(response["pubmed"], {"host:1": {"state": "open", "published_at": now}})
+        assert_equals(response["crossref"], None)
+
+
 class TestItem(ViewsTester):
 
     def test_item_post_unknown_tiid(self):
@@ -322,9 +334,25 @@ class TestCollection(ViewsTester):
         print larry
 
         # test it is on the redis queue
-        response = self.r.rpop("aliasqueue")
-        assert_equals(response, '["moe", {}, []]')
+        response = self.r.rpop("aliasqueue:scheduled-refresh")
+        assert_equals(response, '["moe", {}, [], "scheduled-refresh", "collection:123"]')
         
+    def test_collection_update_only_counts_providers_for_queued_items(self):
+        for doc in mydao.db.update([{"_id":"larry", "aliases":{}}]):
+            pass
+        collection = {
+            "_id":"123",
+            "alias_tiids": {"doi:abc":"larry", "doi:def":"notindb"}
+            }
+        mydao.save(collection)
+        resp = self.client.post(
+            "/collection/123"
+        )
+        assert_equals(resp.data, "true")
+
+        assert myredis.get_num_providers_left("larry") > 0
+        assert_equals(myredis.get_num_providers_left("notindb"), None)
+
     def test_collection_owner_set_at_creation(self):
 
         response = self.client.post(
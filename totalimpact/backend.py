@@ -1,59 +1,463 @@
 #!/usr/bin/env python
 
-import os, time, json, logging, threading, Queue, copy, sys, datetime
-from collections import defaultdict
+import os
+if os.getenv("PROVIDER_ENGINE") == "gevent":
+    # has to happen before anything else imports socket, threading, Queue etc
+    from gevent import monkey
+    monkey.patch_all()
+
+import time, json, logging, threading, Queue, sys, datetime, itertools, uuid
+from collections import defaultdict, namedtuple, deque
+from couchdb import ResourceConflict
+from redis import WatchError
 
 from totalimpact import dao, tiredis, default_settings
+from totalimpact.utils import freeze, thaw, process_name
 from totalimpact.models import ItemFactory
-from totalimpact.providers.provider import ProviderFactory, ProviderError
+from totalimpact.providers.provider import ProviderFactory, ProviderError, ProviderRateLimiter, ProviderHealth, http_session_stats
 
 logger = logging.getLogger('ti.backend')
 logger.setLevel(logging.DEBUG)
 
 thread_count = defaultdict(dict)
 
+
+def priority_rank(priority):
+    # lower runs sooner; anything not in a known lane waits behind all of them
+    try:
+        return default_settings.QUEUE_PRIORITIES.index(priority)
+    except ValueError:
+        return len(default_settings.QUEUE_PRIORITIES)
+
+
+# Queue messages are immutable, with their aliases frozen, so each hop can pass
+# them on without copying.  They are tuples, so they serialize to json lists.
+# Each carries the priority lane and the tenant of the request that started it.
+# Lists queued before those existed are missing them on the end and get the defaults.
+class AliasMessage(namedtuple("AliasMessage", "tiid aliases aliases_providers_run priority tenant")):
+    __slots__ = ()
+
+    def __new__(cls, tiid, aliases, aliases_providers_run, 
+            priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+        return super(AliasMessage, cls).__new__(cls, tiid, aliases, aliases_providers_run, priority, tenant)
+
+    @classmethod
+    def from_list(cls, message_list):
+        (tiid, aliases, aliases_providers_run) = message_list[:3]
+        return cls(tiid, freeze(aliases), tuple(aliases_providers_run), *message_list[3:])
+
+class ProviderMessage(namedtuple("ProviderMessage", "tiid aliases method_name aliases_providers_run priority tenant")):
+    __slots__ = ()
+
+    def __new__(cls, tiid, aliases, method_name, aliases_providers_run, 
+            priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+        return super(ProviderMessage, cls).__new__(cls, tiid, aliases, method_name, aliases_providers_run, 
+            priority, tenant)
+
+    @classmethod
+    def from_list(cls, message_list):
+        (tiid, aliases, method_name, aliases_providers_run) = message_list[:4]
+        return cls(tiid, freeze(aliases), method_name, tuple(aliases_providers_run), *message_list[4:])
+
+# new_content is a provider response, which nothing else holds on to, so isn't frozen
+class CouchMessage(namedtuple("CouchMessage", "tiid new_content method_name priority tenant")):
+    __slots__ = ()
+
+    def __new__(cls, tiid, new_content, method_name, 
+            priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+        return super(CouchMessage, cls).__new__(cls, tiid, new_content, method_name, priority, tenant)
+
+    @classmethod
+    def from_list(cls, message_list):
+        (tiid, new_content, method_name) = message_list[:3]
+        return cls(tiid, new_content, method_name, *message_list[3:])
+
+
+# random per start, since a restarted process (say in a container) can get back
+# the same host and pid, and would then never requeue what its last run left behind
+consumer_start_id = uuid.uuid4().hex[:8]
+
+def consumer_name():
+    # one per backend process, so any number of them can share the queues
+    return process_name() + ":" + consumer_start_id
+
+def consumer_alive_key(consumer):
+    return "backend_alive:" + consumer
+
+REDIS_QUEUE_FIRST_POLL_INTERVAL = 0.01 # seconds
+
+def decr_num_providers_left_when_dead(myredis):
+    """ An on_dead_letter hook for the provider and couch queues.
+
+    A metrics message that is given up on never gets to the couch worker that 
+    would count its provider as done, so it is counted here instead, or its item 
+    would look like it was updating forever.  Delivery is at least once, though, so 
+    a message that was finished but failed before being acked can be counted twice,
+    and can have added its metrics to raw_history twice.
+    """
+    def on_dead_letter(message):
+        if getattr(message, "method_name", None) == "metrics":
+            myredis.decr_num_providers_left(message.tiid, "(dead letter)")
+    return on_dead_letter
+
+
 class RedisQueue(object):
-    def __init__(self, queue_name, myredis):
+    """ A queue in redis, shared by every backend process.
+
+    pop() moves a message onto this process's processing list in the same step, and it
+    stays there until ack()ed.  If the process dies first, a QueueReaper puts it back on 
+    the queue for another process, so a message can occasionally be handled twice.
+    A message that couldn't be finished is nack()ed: put back to try again, until it 
+    has failed max_attempts times and goes on the dead letter list instead.  Then 
+    on_dead_letter, if given, is called with it.
+    """
+    def __init__(self, queue_name, myredis, message_class=AliasMessage, 
+            priorities=default_settings.QUEUE_PRIORITIES, consumer=None,
+            max_attempts=default_settings.QUEUE_MAX_ATTEMPTS, on_dead_letter=None):
         self.queue_name = queue_name
         self.myredis = myredis
+        self.message_class = message_class
         self.name = queue_name + "_queue"
+        self.priorities = priorities
+        # one redis list per lane, most urgent first.  The plain queue_name list
+        # is last so anything queued before there were lanes still gets popped.
+        self.keys = [self.key(priority) for priority in priorities] + [queue_name]
+        if consumer is None:
+            consumer = consumer_name()
+        self.consumer = consumer
+        self.consumers_key = queue_name + ":consumers"
+        self.processing_key = self.processing_key_for(consumer)
+        # failures so far, by message json
+        self.attempts_key = queue_name + ":attempts"
+        self.dead_key = queue_name + ":dead"
+        self.max_attempts = max_attempts
+        self.on_dead_letter = on_dead_letter
+        # the json each popped message came from, until it is acked or nacked
+        self.unacked = {}
+        self.unacked_lock = threading.Lock()
+        self.register()
+
+    def key(self, priority):
+        return self.queue_name + ":" + priority
+
+    def lane_key(self, message):
+        priority = getattr(message, "priority", None)
+        if priority in self.priorities:
+            return self.key(priority)
+        return self.queue_name
+
+    def processing_key_for(self, consumer):
+        return self.queue_name + ":processing:" + consumer
+
+    def register(self):
+        # so a reaper knows to look at our processing list if we die
+        self.myredis.sadd(self.consumers_key, self.consumer)
 
     def push(self, message):
-        message_json = json.dumps(message)
-        #logger.info("{:20}: >>>PUSHING to redis {message_json}".format(
-        #    self.name, message_json=message_json))        
-        self.myredis.lpush(self.queue_name, message_json)
+        self.push_many([message])
 
-    def pop(self):
-        #blocking pop
+    def push_many(self, messages):
+        # all in one round trip, in order
+        if not messages:
+            return
+        pipe = self.myredis.pipeline(transaction=True)
+        for message in messages:
+            pipe.lpush(self.lane_key(message), json.dumps(message))
+        pipe.execute()
+
+    def _requeue(self, message, message_json):
+        # back on the end that pops next, and off our processing list
+        pipe = self.myredis.pipeline(transaction=True)
+        pipe.rpush(self.lane_key(message), message_json)
+        pipe.lrem(self.processing_key, message_json, 1)
+        pipe.execute()
+
+    def _retry(self, message, message_json):
+        # requeue, unless it has already failed too often
+        attempts = self.myredis.hincrby(self.attempts_key, message_json, 1)
+        if attempts < self.max_attempts:
+            self._requeue(message, message_json)
+            return
+        logger.error("{:20}: giving up on {message} after {attempts} attempts, moving it to {dead_key}".format(
+            self.name, message=message, attempts=attempts, dead_key=self.dead_key))
+        pipe = self.myredis.pipeline(transaction=True)
+        pipe.lpush(self.dead_key, message_json)
+        pipe.lrem(self.processing_key, message_json, 1)
+        pipe.hdel(self.attempts_key, message_json)
+        pipe.execute()
+        if self.on_dead_letter:
+            self.on_dead_letter(message)
+
+    def pop(self, timeout=5):
+        messages = self.pop_many(1, timeout)
+        if messages:
+            return messages[0]
+        return None
+
+    def _load_message(self, message_json):
         message = None
-        received = self.myredis.brpop([self.queue_name], timeout=5) #maybe timeout not necessary
-        if received:
-            queue, message_json = received
-            try:
-                message = json.loads(message_json) 
-                logger.info("{:20}: <<<POPPED from redis, {message}".format(
-                    self.name, message=message))        
-            except TypeError, KeyError:
-                logger.info("{:20}: error processing redis message {message_json}".format(
-                    self.name, message_json=message_json))
+        try:
+            message = self.message_class.from_list(json.loads(message_json))
+            logger.debug("{:20}: <<<POPPED from redis, {message}".format(
+                self.name, message=message))        
+        except (TypeError, ValueError, KeyError):
+            logger.info("{:20}: error processing redis message {message_json}".format(
+                self.name, message_json=message_json))
         return message
 
+    def pop_many(self, max_messages, timeout=5):
+        # polls rather than blocking, since a blocking pop would hold a redis 
+        # connection for every idle worker thread.  The wait between polls starts 
+        # short, so a busy queue is drained promptly, and doubles up to 
+        # REDIS_QUEUE_POLL_INTERVAL while the queue stays empty.
+        deadline = time.time() + timeout
+        poll_interval = REDIS_QUEUE_FIRST_POLL_INTERVAL
+        messages_json = self._take_json(max_messages)
+        while not messages_json:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(min(remaining, poll_interval))
+            poll_interval = min(2 * poll_interval, default_settings.REDIS_QUEUE_POLL_INTERVAL)
+            messages_json = self._take_json(max_messages)
+
+        messages = []
+        for message_json in messages_json:
+            message = self._load_message(message_json)
+            if message is None:
+                # it will never load, so don't leave it around to be requeued
+                self.myredis.lrem(self.processing_key, message_json, 1)
+                continue
+            with self.unacked_lock:
+                self.unacked[id(message)] = (message, message_json)
+            messages.append(message)
+        return messages
+
+    def _take_json(self, max_messages):
+        # the oldest message in the most urgent lane with anything waiting, then up to 
+        # max_messages-1 more from the same lane in one MULTI, so a batch never mixes lanes
+        for key in self.keys:
+            first_message_json = self.myredis.rpoplpush(key, self.processing_key)
+            if first_message_json is None:
+                continue
+            messages_json = [first_message_json]
+            if max_messages > 1:
+                pipe = self.myredis.pipeline(transaction=True)
+                for i in range(max_messages-1):
+                    pipe.rpoplpush(key, self.processing_key)
+                messages_json += [message_json for message_json in pipe.execute() if message_json is not None]
+            return messages_json
+        return []
+
+    def _take_unacked(self, messages):
+        # the json of those of these messages we popped and haven't acked or nacked yet
+        messages_json = []
+        with self.unacked_lock:
+            for message in messages:
+                (popped_message, message_json) = self.unacked.pop(id(message), (None, None))
+                if message_json is not None:
+                    messages_json.append((message, message_json))
+        return messages_json
+
+    def ack(self, messages):
+        # finished with these, so they come off our processing list
+        messages_json = self._take_unacked(messages)
+        if messages_json:
+            pipe = self.myredis.pipeline(transaction=False)
+            for (message, message_json) in messages_json:
+                pipe.lrem(self.processing_key, message_json, 1)
+                pipe.hdel(self.attempts_key, message_json)
+            pipe.execute()
+
+    def nack(self, messages):
+        # couldn't finish these, so they go back on the queue for another try
+        for (message, message_json) in self._take_unacked(messages):
+            self._retry(message, message_json)
+
+    def requeue_abandoned(self):
+        # puts back whatever backend processes that have died had popped but not acked
+        for consumer in self.myredis.smembers(self.consumers_key):
+            if (consumer == self.consumer) or self.myredis.exists(consumer_alive_key(consumer)):
+                continue
+            abandoned_key = self.processing_key_for(consumer)
+            num_requeued = 0
+            while True:
+                # onto our own processing list first, so nothing is lost if we die too
+                message_json = self.myredis.rpoplpush(abandoned_key, self.processing_key)
+                if message_json is None:
+                    break
+                message = self._load_message(message_json)
+                if message is None:
+                    self.myredis.lrem(self.processing_key, message_json, 1)
+                else:
+                    # counts as a failure, in case it's the message that killed the process
+                    self._retry(message, message_json)
+                    num_requeued += 1
+            self.myredis.srem(self.consumers_key, consumer)
+            logger.info("{:20}: requeued {num} messages left by {consumer}".format(
+                self.name, num=num_requeued, consumer=consumer))
+
+
+class RedisFairQueue(RedisQueue):
+    """ A RedisQueue that shares each priority lane fairly between tenants.
+
+    Messages still come out most urgent lane first.  Within a lane each tenant's
+    messages wait on their own list, and the tenants with messages waiting take turns
+    in a ring that every backend process rotates.  On its turn a tenant gets as many 
+    messages as its weight in QUEUE_TENANT_WEIGHTS.
+    """
+    def __init__(self, queue_name, myredis, message_class=ProviderMessage, 
+            priorities=default_settings.QUEUE_PRIORITIES, consumer=None, weights=None,
+            max_attempts=default_settings.QUEUE_MAX_ATTEMPTS, on_dead_letter=None):
+        super(RedisFairQueue, self).__init__(queue_name, myredis, message_class, priorities, consumer, 
+            max_attempts, on_dead_letter)
+        if weights is None:
+            weights = default_settings.QUEUE_TENANT_WEIGHTS
+        self.weights = weights
+        # nothing from before there were lanes to look for
+        self.keys = [self.key(priority) for priority in priorities]
+
+    def lane_key(self, message):
+        priority = getattr(message, "priority", None)
+        if priority not in self.priorities:
+            priority = self.priorities[-1]
+        return self.key(priority)
+
+    def tenant_key(self, lane_key, tenant):
+        return lane_key + ":tenant:" + tenant
+
+    def turns_key(self, lane_key):
+        return lane_key + ":turns"
+
+    def waiting_key(self, lane_key):
+        return lane_key + ":waiting"
+
+    def tenant(self, message):
+        return getattr(message, "tenant", None) or ""
+
+    def weight(self, tenant):
+        return max(1, int(self.weights.get(tenant, default_settings.QUEUE_DEFAULT_TENANT_WEIGHT)))
+
+    def _add_many(self, messages_and_json, requeue=False):
+        pipe = self.myredis.pipeline(transaction=True)
+        lanes_and_tenants = []
+        for (message, message_json) in messages_and_json:
+            lane_key = self.lane_key(message)
+            tenant = self.tenant(message)
+            if requeue:
+                # back on the end that pops next, and off our processing list
+                pipe.rpush(self.tenant_key(lane_key, tenant), message_json)
+                pipe.lrem(self.processing_key, message_json, 1)
+            else:
+                pipe.lpush(self.tenant_key(lane_key, tenant), message_json)
+            pipe.sadd(self.waiting_key(lane_key), tenant)
+            lanes_and_tenants.append((lane_key, tenant))
+        # each message's sadd reply is the last of its commands
+        commands_per_message = 3 if requeue else 2
+        newly_waiting = pipe.execute()[commands_per_message-1::commands_per_message]
+        pipe = self.myredis.pipeline(transaction=False)
+        for ((lane_key, tenant), is_newly_waiting) in zip(lanes_and_tenants, newly_waiting):
+            if is_newly_waiting:
+                # a tenant that wasn't waiting joins the ring at the back
+                pipe.lpush(self.turns_key(lane_key), tenant)
+        pipe.execute()
+
+    def push(self, message):
+        self.push_many([message])
+
+    def push_many(self, messages):
+        if not messages:
+            return
+        self._add_many([(message, json.dumps(message)) for message in messages])
+
+    def _requeue(self, message, message_json):
+        self._add_many([(message, message_json)], requeue=True)
+
+    def _take_json(self, max_messages):
+        # a batch never mixes lanes
+        for lane_key in self.keys:
+            messages_json = self._take_turns(lane_key, max_messages)
+            if messages_json:
+                return messages_json
+        return []
+
+    def _take_turns(self, lane_key, max_messages):
+        turns_key = self.turns_key(lane_key)
+        messages_json = []
+        num_empty_turns = 0
+        while len(messages_json) < max_messages:
+            # whose turn it is, and they go to the back of the ring
+            pipe = self.myredis.pipeline(transaction=True)
+            pipe.rpoplpush(turns_key, turns_key)
+            pipe.llen(turns_key)
+            (tenant, num_tenants) = pipe.execute()
+            if tenant is None:
+                break
+            if num_tenants == 1:
+                # nobody else is waiting, so no need to take turns
+                num_to_take = max_messages - len(messages_json)
+            else:
+                num_to_take = min(self.weight(tenant), max_messages - len(messages_json))
+
+            pipe = self.myredis.pipeline(transaction=True)
+            for i in range(num_to_take):
+                pipe.rpoplpush(self.tenant_key(lane_key, tenant), self.processing_key)
+            taken = [message_json for message_json in pipe.execute() if message_json is not None]
+            if taken:
+                messages_json += taken
+                num_empty_turns = 0
+            else:
+                self._retire_tenant(lane_key, tenant)
+                num_empty_turns += 1
+                if num_empty_turns > num_tenants:
+                    break
+        return messages_json
+
+    def _retire_tenant(self, lane_key, tenant):
+        # out of the ring, unless a message for it arrived in the meantime
+        tenant_key = self.tenant_key(lane_key, tenant)
+        pipe = self.myredis.pipeline()
+        try:
+            pipe.watch(tenant_key)
+            if pipe.llen(tenant_key):
+                return
+            pipe.multi()
+            pipe.lrem(self.turns_key(lane_key), tenant, 0)
+            pipe.srem(self.waiting_key(lane_key), tenant)
+            pipe.execute()
+        except WatchError:
+            pass
+        finally:
+            pipe.reset()
+
 
 class PythonQueue(object):
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, max_attempts=default_settings.QUEUE_MAX_ATTEMPTS, on_dead_letter=None):
         self.queue_name = queue_name
-        self.queue = Queue.Queue()
+        # entries are (lane rank, arrival order, message), so messages come out
+        # by lane and then first in first out
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        # failures so far, by message json
+        self.attempts = {}
+        self.max_attempts = max_attempts
+        self.on_dead_letter = on_dead_letter
 
     def push(self, message):
-        self.queue.put(copy.deepcopy(message))
+        # messages are immutable, so no need to copy them
+        rank = priority_rank(getattr(message, "priority", None))
+        self.queue.put((rank, next(self.counter), message))
         #logger.info("{:20}: >>>PUSHED".format(
         #        self.queue_name))
 
+    def push_many(self, messages):
+        for message in messages:
+            self.push(message)
+
     def pop(self):
         try:
             # blocking pop
-            message = copy.deepcopy(self.queue.get(block=True, timeout=5)) #maybe timeout isn't necessary
+            (rank, order, message) = self.queue.get(block=True, timeout=5) #maybe timeout isn't necessary
             self.queue.task_done()
             #logger.info("{:20}: <<<POPPED".format(
             #    self.queue_name))
@@ -61,19 +465,183 @@ class PythonQueue(object):
             message = None
         return message
 
+    def pop_many(self, max_messages, timeout=5):
+        # blocks for the first message only, then takes whatever else is waiting
+        messages = []
+        try:
+            messages.append(self.queue.get(block=True, timeout=timeout)[2])
+            self.queue.task_done()
+            while len(messages) < max_messages:
+                messages.append(self.queue.get_nowait()[2])
+                self.queue.task_done()
+        except Queue.Empty:
+            pass
+        return messages
+
+    def ack(self, messages):
+        # nothing else to do, since nothing outlives the process
+        if self.attempts:
+            for message in messages:
+                self.attempts.pop(json.dumps(message), None)
+
+    def nack(self, messages):
+        # back on the queue to try again, unless it has already failed too often
+        for message in messages:
+            message_json = json.dumps(message)
+            attempts = self.attempts.get(message_json, 0) + 1
+            if attempts < self.max_attempts:
+                self.attempts[message_json] = attempts
+                self.push(message)
+            else:
+                self.attempts.pop(message_json, None)
+                logger.error("{:20}: giving up on {message} after {attempts} attempts".format(
+                    self.queue_name, message=message, attempts=attempts))
+                if self.on_dead_letter:
+                    self.on_dead_letter(message)
+
 
 class Worker(object):
+    # seconds to wait after run() raises, doubling while it keeps failing
+    error_backoff_max = default_settings.WORKER_ERROR_BACKOFF_MAX
+
     def run_in_loop(self):
+        # an error, like redis going away for a moment, mustn't end the thread for good
+        error_backoff = 0
         while True:
-            self.run()
+            try:
+                self.run()
+                error_backoff = 0
+            except Exception:
+                error_backoff = min(max(1, 2 * error_backoff), self.error_backoff_max)
+                logger.exception("{:20}: run failed, trying again in {seconds} seconds".format(
+                    self.name, seconds=error_backoff))
+                time.sleep(error_backoff)
 
     def spawn_and_loop(self):
         t = threading.Thread(target=self.run_in_loop, name=self.name+"_thread")
         t.daemon = True
         t.start()    
 
+class QueueReaper(Worker):
+    """ Keeps this backend process marked alive in redis, and puts back on the queues
+    anything popped by backend processes that died before acking it.
+    """
+    def __init__(self, myredis, consumer=None, queues=None, 
+            alive_ttl=default_settings.BACKEND_ALIVE_TTL):
+        self.myredis = myredis
+        if consumer is None:
+            consumer = consumer_name()
+        self.consumer = consumer
+        self.queues = queues or []
+        self.alive_ttl = alive_ttl
+        self.name = "queue_reaper"
+
+    def mark_alive(self):
+        self.myredis.setex(consumer_alive_key(self.consumer), "1", self.alive_ttl)
+        for queue in self.queues:
+            queue.register()
+
+    def run(self):
+        self.mark_alive()
+        for queue in self.queues:
+            queue.requeue_abandoned()
+        time.sleep(self.alive_ttl / 3.0)
+
+
+class ProviderThreadPool(object):
+    """ A fixed number of threads working through a bounded backlog of provider calls.
+
+    submit() blocks while the backlog is full, so a worker feeding the pool stops
+    popping its provider queue until a thread frees up.  Threads take backlogged
+    calls in priority lane order.
+    """
+    def __init__(self, name, max_threads, max_backlog, health=None):
+        self.name = name
+        self.max_threads = max_threads
+        self.tasks = Queue.PriorityQueue(maxsize=max_backlog)
+        self.counter = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+        # if given a ProviderHealth, only run as many tasks at once as it allows
+        self.health = health
+        self.num_running = 0
+        self.running_changed = threading.Condition()
+
+    def _start_threads(self):
+        with self.lock:
+            while len(self.threads) < self.max_threads:
+                t = threading.Thread(target=self._work, 
+                    name="{name}-{i}".format(name=self.name, i=len(self.threads)))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def concurrency_limit(self):
+        if self.health:
+            return min(self.max_threads, self.health.concurrency_limit())
+        return self.max_threads
+
+    def _work(self):
+        while True:
+            (rank, order, func, args) = self.tasks.get(block=True)
+            with self.running_changed:
+                while self.num_running >= self.concurrency_limit():
+                    self.running_changed.wait()
+                self.num_running += 1
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("{:20}: uncaught exception in pool thread".format(self.name))
+            finally:
+                with self.running_changed:
+                    self.num_running -= 1
+                    self.running_changed.notify_all()
+                self.tasks.task_done()
+
+    def try_take_slot(self):
+        # for a running call that wants to make another request alongside its own.
+        # Doesn't wait: the caller makes the request itself if no slot is free
+        with self.running_changed:
+            if self.num_running < self.concurrency_limit():
+                self.num_running += 1
+                return True
+            return False
+
+    def release_slot(self):
+        with self.running_changed:
+            self.num_running -= 1
+            self.running_changed.notify_all()
+
+    def submit(self, func, *args, **kwargs):
+        priority = kwargs.pop("priority", default_settings.DEFAULT_QUEUE_PRIORITY)
+        if len(self.threads) < self.max_threads:
+            self._start_threads()
+        self.tasks.put((priority_rank(priority), next(self.counter), func, args), block=True)
+
+    def backlog_size(self):
+        return self.tasks.qsize()
+
+
+def provider_pool_sizes(provider_config, engine=default_settings.PROVIDER_ENGINE):
+    """ Returns (max_threads, max_backlog) for a provider's pool.  
+
+    Under the gevent engine the pool's "threads" are greenlets, so the defaults are much larger.
+    """
+    if engine == "gevent":
+        default_workers = default_settings.PROVIDER_WORKER_GREENLETS
+        default_backlog = default_settings.PROVIDER_WORKER_GREENLET_BACKLOG
+    else:
+        default_workers = default_settings.PROVIDER_WORKER_THREADS
+        default_backlog = default_settings.PROVIDER_WORKER_BACKLOG
+    max_threads = provider_config.get("workers", default_workers)
+    max_backlog = provider_config.get("backlog", default_backlog)
+    return (max_threads, max_backlog)
+
+
 class ProviderWorker(Worker):
-    def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis):
+    def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis,
+            max_threads=default_settings.PROVIDER_WORKER_THREADS, 
+            max_backlog=default_settings.PROVIDER_WORKER_BACKLOG):
         self.provider = provider
         self.provider_name = provider.provider_name
         self.polling_interval = polling_interval 
@@ -83,9 +651,13 @@ class ProviderWorker(Worker):
         self.wrapper = wrapper
         self.myredis = myredis
         self.name = self.provider_name+"_worker"
+        self.pool = ProviderThreadPool(self.provider_name+"_pool", max_threads, max_backlog, provider.health)
+        # so the provider's own concurrent lookups count against the pool too
+        self.provider.pool = self.pool
 
-    # last variable is an artifact so it has same call signature as other callbacks
-    def add_to_couch_queue_if_nonzero(self, tiid, new_content, method_name, dummy=None):
+    # dummy is an artifact so it has same call signature as other callbacks
+    def add_to_couch_queue_if_nonzero(self, tiid, new_content, method_name, dummy=None, 
+            priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
         if not new_content:
             #logger.info("{:20}: Not writing to couch: empty {method_name} from {tiid} for {provider_name}".format(
             #    "provider_worker", method_name=method_name, tiid=tiid, provider_name=self.provider_name))     
@@ -95,14 +667,15 @@ class ProviderWorker(Worker):
         else:
             logger.info("Adding to couch queue {method_name} from {tiid} for {provider_name}".format(
                 method_name=method_name, tiid=tiid, provider_name=self.provider_name))     
-            couch_message = (tiid, new_content, method_name)
+            couch_message = CouchMessage(tiid, new_content, method_name, priority, tenant)
             couch_queue_index = tiid[0] #index them by the first letter in the tiid
             selected_couch_queue = self.couch_queues[couch_queue_index] 
             selected_couch_queue.push(couch_message)
 
-    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run):
-        self.add_to_couch_queue_if_nonzero(tiid, alias_dict, method_name)
-        alias_message = [tiid, alias_dict, aliases_providers_run]
+    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run, 
+            priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+        self.add_to_couch_queue_if_nonzero(tiid, alias_dict, method_name, priority=priority, tenant=tenant)
+        alias_message = AliasMessage(tiid, freeze(alias_dict), aliases_providers_run, priority, tenant)
         self.alias_queue.push(alias_message)
 
     @classmethod
@@ -123,9 +696,41 @@ class ProviderWorker(Worker):
             logger.info("{:20}: **ProviderError {tiid} {method_name} {provider_name} ".format(
                 worker_name, tiid=tiid, provider_name=provider_name.upper(), method_name=method_name.upper()))
 
+        return cls.finish_call(tiid, input_aliases_dict, provider_name, method_name, 
+            aliases_providers_run, callback, method_response)
+
+    @classmethod
+    def batch_wrapper(cls, provider_messages, provider, method_name, callback):
+        provider_name = provider.provider_name
+        worker_name = provider_name+"_worker"
+
+        list_of_alias_tuples = [ItemFactory.alias_tuples_from_dict(provider_message.aliases) 
+            for provider_message in provider_messages]
+        method = getattr(provider, method_name+"_batch")
+
+        try:
+            method_responses = method(list_of_alias_tuples)
+        except ProviderError:
+            # one bad id can fail the whole batch, so give each item its own call
+            logger.info("{:20}: **ProviderError in batch of {num} {method_name} {provider_name}, trying one at a time".format(
+                worker_name, num=len(provider_messages), provider_name=provider_name.upper(), method_name=method_name.upper()))
+            return [cls.wrapper(provider_message.tiid, provider_message.aliases, provider, method_name, 
+                        provider_message.aliases_providers_run, callback)
+                    for provider_message in provider_messages]
+
+        responses = []
+        for (provider_message, method_response) in zip(provider_messages, method_responses):
+            responses.append(cls.finish_call(provider_message.tiid, provider_message.aliases, 
+                provider_name, method_name, provider_message.aliases_providers_run, callback, method_response))
+        return responses
+
+    @classmethod
+    def finish_call(cls, tiid, input_aliases_dict, provider_name, method_name, aliases_providers_run, callback, method_response):
+        worker_name = provider_name+"_worker"
+
         if method_name == "aliases":
             # update aliases to include the old ones too
-            aliases_providers_run += [provider_name]
+            aliases_providers_run = tuple(aliases_providers_run) + (provider_name,)
             if method_response:
                 new_aliases_dict = ItemFactory.alias_dict_from_tuples(method_response)
                 response = ItemFactory.merge_alias_dicts(new_aliases_dict, input_aliases_dict)
@@ -147,35 +752,101 @@ class ProviderWorker(Worker):
 
         return response
 
-    def run(self):
-        provider_message = self.provider_queue.pop()
-        if provider_message:
-            #logger.info("POPPED from queue for {provider}".format(
-            #    provider=self.provider_name))
-            (tiid, alias_dict, method_name, aliases_providers_run) = provider_message
-            if method_name == "aliases":
-                callback = self.add_to_alias_and_couch_queues
+    def _callback(self, method_name, priority, tenants_by_tiid):
+        # results stay in the lane, and with the tenant, of the request that asked for them
+        if method_name == "aliases":
+            add_to_queues = self.add_to_alias_and_couch_queues
+        else:
+            add_to_queues = self.add_to_couch_queue_if_nonzero
+        def callback(tiid, new_content, method_name, aliases_providers_run):
+            add_to_queues(tiid, new_content, method_name, aliases_providers_run, 
+                priority=priority, tenant=tenants_by_tiid.get(tiid))
+        return callback
+
+    def _log_pending(self):
+        logger.info("NUMBER of {provider} calls pending = {num_provider}, backlog = {num_backlog}, concurrency limit = {limit}, all threads = {num_total}".format(
+            num_provider=len(thread_count[self.provider.provider_name]),
+            num_backlog=self.pool.backlog_size(),
+            limit=self.pool.concurrency_limit(),
+            num_total=threading.active_count(),
+            provider=self.provider.provider_name.upper()))
+        logger.debug("HTTP connections for {provider}: {stats}".format(
+            provider=self.provider.provider_name.upper(), 
+            stats=http_session_stats(self.provider_name)))
+
+    def _call_and_ack(self, provider_messages, func, *args):
+        # acks only once the results are on the next queues.  If func raises, the 
+        # messages are nacked to be tried again, and the exception goes on to the pool
+        succeeded = False
+        try:
+            func(*args)
+            succeeded = True
+        finally:
+            if succeeded:
+                self.provider_queue.ack(provider_messages)
             else:
-                callback = self.add_to_couch_queue_if_nonzero
+                self.provider_queue.nack(provider_messages)
+
+    def _submit_message(self, provider_message):
+        (tiid, method_name, priority) = (provider_message.tiid, provider_message.method_name, provider_message.priority)
+
+        thread_count[self.provider.provider_name][tiid+method_name] = 1
+        self._log_pending()
 
-            #logger.info("BEFORE STARTING thread for {tiid} {method_name} {provider}".format(
-            #    method_name=method_name.upper(), tiid=tiid, num=len(thread_count[self.provider.provider_name].keys()),
-            #    provider=self.provider.provider_name.upper()))
+        # blocks when the pool's backlog is full, which leaves the rest 
+        # of the messages waiting on provider_queue
+        self.pool.submit(self._call_and_ack, [provider_message], ProviderWorker.wrapper, 
+            tiid, provider_message.aliases, self.provider, method_name, provider_message.aliases_providers_run, 
+            self._callback(method_name, priority, {tiid: provider_message.tenant}), 
+            priority=priority)
 
-            thread_count[self.provider.provider_name][tiid+method_name] = 1
+    def _submit_batch(self, provider_messages, method_name, priority):
+        for provider_message in provider_messages:
+            thread_count[self.provider.provider_name][provider_message.tiid+method_name] = 1
+        self._log_pending()
 
-            logger.info("NUMBER of {provider} threads = {num_provider}, all threads = {num_total}".format(
-                num_provider=len(thread_count[self.provider.provider_name]),
-                num_total=threading.active_count(),
-                provider=self.provider.provider_name.upper()))
+        tenants_by_tiid = dict([(provider_message.tiid, provider_message.tenant) 
+            for provider_message in provider_messages])
+        self.pool.submit(self._call_and_ack, provider_messages, ProviderWorker.batch_wrapper, 
+            provider_messages, self.provider, method_name, self._callback(method_name, priority, tenants_by_tiid), 
+            priority=priority)
+
+    def batch_methods(self):
+        return [method_name for method_name in ["aliases", "biblio", "metrics"]
+            if getattr(self.provider, "provides_"+method_name+"_batch")]
+
+    def batch_size(self):
+        return max([getattr(self.provider, method_name+"_batch_size") 
+            for method_name in self.batch_methods()] + [1])
+
+    def run(self):
+        if self.batch_methods():
+            provider_messages = self.provider_queue.pop_many(self.batch_size())
+        else:
+            provider_message = self.provider_queue.pop()
+            provider_messages = [provider_message] if provider_message else []
 
-            t = threading.Thread(target=ProviderWorker.wrapper, 
-                args=(tiid, alias_dict, self.provider, method_name, aliases_providers_run, callback), 
-                name=self.provider_name+"-"+method_name.upper()+"-"+tiid[0:4])
-            t.start()
+        if provider_messages:
+            # messages for methods the provider can batch go out as one call per method
+            # and lane, everything else one at a time.  The most urgent lane goes first.
+            priorities = sorted(set([provider_message.priority for provider_message in provider_messages]), 
+                key=priority_rank)
+            for priority in priorities:
+                single_messages = []
+                for method_name in ["aliases", "biblio", "metrics"]:
+                    method_messages = [provider_message for provider_message in provider_messages 
+                        if (provider_message.method_name == method_name) and (provider_message.priority == priority)]
+                    if (len(method_messages) > 1) and (method_name in self.batch_methods()):
+                        self._submit_batch(method_messages, method_name, priority)
+                    else:
+                        single_messages += method_messages
+
+                for provider_message in single_messages:
+                    self._submit_message(provider_message)
 
             # sleep to give the provider a rest :)
-            time.sleep(self.polling_interval)
+            if self.polling_interval:
+                time.sleep(self.polling_interval)
 
 
 
@@ -188,7 +859,7 @@ class CouchWorker(Worker):
 
     @classmethod
     def update_item_with_new_aliases(cls, alias_dict, item):
-        if alias_dict == item["aliases"]:
+        if thaw(alias_dict) == item["aliases"]:
             item = None
         else:
             merged_aliases = ItemFactory.merge_alias_dicts(alias_dict, item["aliases"])
@@ -216,45 +887,172 @@ class CouchWorker(Worker):
             provider_name = "(unknown)"
         self.myredis.decr_num_providers_left(tiid, provider_name)
 
+    @classmethod
+    def update_item(cls, item, new_content, method_name):
+        # returns None if no changes
+        if method_name=="aliases":
+            updated_item = cls.update_item_with_new_aliases(new_content, item)
+        elif method_name=="biblio":
+            updated_item = cls.update_item_with_new_biblio(new_content, item)
+        elif method_name=="metrics":
+            updated_item = item
+            for metric_name in new_content:
+                updated_item = cls.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item)
+        else:
+            logger.warning("ack, supposed to save something i don't know about: " + str(new_content))
+            updated_item = None
+        return updated_item
+
+    @classmethod
+    def update_item_with_messages(cls, item, couch_messages):
+        # applies the messages in the order they arrived; returns None if no changes
+        changed = False
+        for couch_message in couch_messages:
+            updated_item = cls.update_item(item, couch_message.new_content, couch_message.method_name)
+            if updated_item:
+                item = updated_item
+                changed = True
+        if not changed:
+            return None
+        return item
+
+    def save_items(self, updated_items, messages_by_tiid, 
+            max_retries=default_settings.COUCH_WORKER_CONFLICT_RETRIES):
+        # Someone else may have saved an item since we read it.  Then couch rejects
+        # our revision, so read it again, re-apply our messages on top, and retry.
+        # Returns the tiids that couldn't be saved.
+        unsaved_tiids = []
+        retries = 0
+        while updated_items:
+            conflicted_tiids = []
+            try:
+                save_results = self.mydao.save_many(updated_items)
+            except Exception:
+                logger.exception("{:20}: couldn't save {num} items".format(
+                    self.name, num=len(updated_items)))
+                unsaved_tiids += [updated_item["_id"] for updated_item in updated_items]
+                break
+            for (success, tiid, rev_or_exception) in save_results:
+                if success:
+                    continue
+                if isinstance(rev_or_exception, ResourceConflict):
+                    conflicted_tiids.append(tiid)
+                else:
+                    logger.error("{:20}: couldn't save {tiid}: {error}".format(
+                        self.name, tiid=tiid, error=rev_or_exception))
+                    unsaved_tiids.append(tiid)
+
+            if not conflicted_tiids:
+                break
+            if retries >= max_retries:
+                logger.error("{:20}: gave up saving {tiids} after {retries} conflicts".format(
+                    self.name, tiids=conflicted_tiids, retries=retries))
+                unsaved_tiids += conflicted_tiids
+                break
+            retries += 1
+            logger.info("{:20}: conflict saving {tiids}, merging again (retry {retries})".format(
+                self.name, tiids=conflicted_tiids, retries=retries))
+
+            try:
+                items = self.mydao.get_many(conflicted_tiids)
+            except Exception:
+                logger.exception("{:20}: couldn't read {tiids} again after a conflict".format(
+                    self.name, tiids=conflicted_tiids))
+                unsaved_tiids += conflicted_tiids
+                break
+            updated_items = []
+            for tiid in conflicted_tiids:
+                if tiid not in items:
+                    continue
+                updated_item = self.update_item_with_messages(items[tiid], messages_by_tiid[tiid])
+                if updated_item:
+                    updated_item["last_modified"] = datetime.datetime.now().isoformat()
+                    updated_items.append(updated_item)
+        return unsaved_tiids
+
+    def _finish_messages(self, tiid, couch_messages):
+        for couch_message in couch_messages:
+            if couch_message.method_name=="metrics":
+                metric_name = couch_message.new_content.keys()[0]
+                self.decr_num_providers_left(metric_name, tiid) # have to do this after the item save
+
     def run(self):
-        couch_message = self.couch_queue.pop()
-        if couch_message:
-            (tiid, new_content, method_name) = couch_message
-            if not new_content:
+        couch_messages = self.couch_queue.pop_many(default_settings.COUCH_WORKER_BATCH_SIZE)
+        if not couch_messages:
+            #time.sleep(0.1)  # is this necessary?
+            return
+
+        try:
+            finished_messages = self.save_messages(couch_messages)
+        except Exception:
+            # couldn't read the items from couch
+            logger.exception("{:20}: couldn't save {num} messages".format(
+                self.name, num=len(couch_messages)))
+            finished_messages = []
+        # only now, so if this process dies before saving, another one saves them instead.
+        # The rest are tried again later
+        finished_ids = set([id(couch_message) for couch_message in finished_messages])
+        self.couch_queue.ack(finished_messages)
+        self.couch_queue.nack([couch_message for couch_message in couch_messages 
+            if id(couch_message) not in finished_ids])
+
+    def save_messages(self, couch_messages):
+        # Returns the messages that are finished with: saved, or with nothing to save.
+        # Raises if the items can't be read from couch.
+        finished_messages = []
+
+        # group by tiid, keeping the order the messages arrived in
+        messages_by_tiid = {}
+        tiids = []
+        for couch_message in couch_messages:
+            tiid = couch_message.tiid
+            if not couch_message.new_content:
                 logger.info("{:20}: blank doc, nothing to save".format(
                     self.name))
-            else:
-                item = self.mydao.get(tiid)
-                if not item:
-                    if method_name=="metrics":
+                finished_messages.append(couch_message)
+                continue
+            if tiid not in messages_by_tiid:
+                messages_by_tiid[tiid] = []
+                tiids.append(tiid)
+            messages_by_tiid[tiid].append(couch_message)
+
+        if not tiids:
+            return finished_messages
+
+        items = self.mydao.get_many(tiids)
+
+        updated_items = []
+        for tiid in tiids:
+            item = items.get(tiid)
+            if not item:
+                # couch answered and the item isn't there, so trying again won't help
+                for couch_message in messages_by_tiid[tiid]:
+                    if couch_message.method_name=="metrics":
                         self.myredis.decr_num_providers_left(tiid, "(unknown)")
                     logger.error("Empty item from couch for tiid {tiid}, can't save {method_name}".format(
-                        tiid=tiid, method_name=method_name))
-                    return
-                if method_name=="aliases":
-                    updated_item = self.update_item_with_new_aliases(new_content, item)
-                elif method_name=="biblio":
-                    updated_item = self.update_item_with_new_biblio(new_content, item)
-                elif method_name=="metrics":
-                    updated_item = item
-                    for metric_name in new_content:
-                        updated_item = self.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item)
-                else:
-                    logger.warning("ack, supposed to save something i don't know about: " + str(new_content))
-                    updated_item = None
+                        tiid=tiid, method_name=couch_message.method_name))
+                finished_messages += messages_by_tiid.pop(tiid)
+                continue
 
-                # now that is has been updated it, change last_modified and save
-                if updated_item:
-                    updated_item["last_modified"] = datetime.datetime.now().isoformat()
-                    logger.info("{:20}: added {method_name}, saving item {tiid}".format(
-                        self.name, method_name=method_name, tiid=tiid))
-                    self.mydao.save(updated_item)
+            updated_item = self.update_item_with_messages(item, messages_by_tiid[tiid])
 
-                if method_name=="metrics":
-                    self.decr_num_providers_left(metric_name, tiid) # have to do this after the item save
-        else:
-            #time.sleep(0.1)  # is this necessary?
-            pass
+            # now that is has been updated it, change last_modified and save
+            if updated_item:
+                updated_item["last_modified"] = datetime.datetime.now().isoformat()
+                updated_items.append(updated_item)
+
+        unsaved_tiids = []
+        if updated_items:
+            logger.info("{:20}: saving {num_items} items updated by {num_messages} messages".format(
+                self.name, num_items=len(updated_items), num_messages=len(couch_messages)))
+            unsaved_tiids = self.save_items(updated_items, messages_by_tiid)
+
+        for tiid in messages_by_tiid:
+            if tiid in unsaved_tiids:
+                continue
+            self._finish_messages(tiid, messages_by_tiid[tiid])
+            finished_messages += messages_by_tiid[tiid]
+        return finished_messages
 
 
 class Backend(Worker):
@@ -272,8 +1070,7 @@ class Backend(Worker):
         biblio_providers = []
         metrics_providers = []
 
-        all_metrics_providers = [provider.provider_name for provider in 
-                        ProviderFactory.get_providers(provider_config, "metrics")]
+        all_metrics_providers = ProviderFactory.get_registry(provider_config).get_provider_names("metrics")
         (genre, host) = ItemFactory.decide_genre(item_aliases)
         has_alias_urls = "url" in item_aliases
 
@@ -303,25 +1100,43 @@ class Backend(Worker):
             "biblio":biblio_providers,
             "metrics":metrics_providers})
 
-    def run(self):
-        alias_message = self.alias_queue.pop()
-        if alias_message:
-            logger.info("alias_message said {alias_message}".format(
-                alias_message=alias_message))            
-            (tiid, alias_dict, aliases_providers_run) = alias_message
-
+    def route(self, alias_messages):
+        # one sniffer call per message, pushed in method order across the whole batch,
+        # so all the aliases calls are queued before biblio, then metrics.  Each 
+        # provider queue gets its share in one push.
+        provider_messages_by_method = {"aliases":[], "biblio":[], "metrics":[]}
+        for alias_message in alias_messages:
+            (tiid, alias_dict, aliases_providers_run, priority, tenant) = alias_message
             relevant_provider_names = self.sniffer(alias_dict, aliases_providers_run)
-            logger.info("backend for {tiid} sniffer got input {alias_dict}".format(
-                tiid=tiid, alias_dict=alias_dict))
-            logger.info("backend for {tiid} sniffer returned {providers}".format(
-                tiid=tiid, providers=relevant_provider_names))
+            logger.debug("backend for {tiid} sniffer got input {alias_dict} and returned {providers}".format(
+                tiid=tiid, alias_dict=alias_dict, providers=relevant_provider_names))
 
-            # list out the method names so they are run in that priority, biblio before metrics
             for method_name in ["aliases", "biblio", "metrics"]:
                 for provider_name in relevant_provider_names[method_name]:
+                    provider_message = ProviderMessage(tiid, alias_dict, method_name, aliases_providers_run, 
+                        priority, tenant)
+                    provider_messages_by_method[method_name].append((provider_name, provider_message))
 
-                    provider_message = (tiid, alias_dict, method_name, aliases_providers_run)
-                    self.provider_queues[provider_name].push(provider_message)
+        provider_messages_by_provider = {}
+        for method_name in ["aliases", "biblio", "metrics"]:
+            for (provider_name, provider_message) in provider_messages_by_method[method_name]:
+                provider_messages_by_provider.setdefault(provider_name, []).append(provider_message)
+        for (provider_name, provider_messages) in provider_messages_by_provider.items():
+            self.provider_queues[provider_name].push_many(provider_messages)
+
+    def run(self):
+        alias_messages = self.alias_queue.pop_many(default_settings.BACKEND_ALIAS_BATCH_SIZE)
+        if alias_messages:
+            logger.info("backend routing {num} alias messages".format(
+                num=len(alias_messages)))
+            try:
+                self.route(alias_messages)
+            except Exception:
+                logger.exception("backend couldn't route {num} alias messages".format(
+                    num=len(alias_messages)))
+                self.alias_queue.nack(alias_messages)
+                return
+            self.alias_queue.ack(alias_messages)
         else:
             #time.sleep(0.1)  # is this necessary?
             pass
@@ -329,31 +1144,52 @@ class Backend(Worker):
 
 
 def main():
+    logger.info("backend starting with the {engine} provider engine".format(
+        engine=default_settings.PROVIDER_ENGINE))
+
     mydao = dao.Dao(os.environ["CLOUDANT_URL"], os.environ["CLOUDANT_DB"])
 
     myredis = tiredis.from_url(os.getenv("REDISTOGO_URL"))
-    alias_queue = RedisQueue("aliasqueue", myredis)
+
+    # every queue is in redis, so any number of these processes can share the work
+    consumer = consumer_name()
+    on_dead_letter = decr_num_providers_left_when_dead(myredis)
+    reaper = QueueReaper(myredis, consumer)
+    reaper.mark_alive()  # before popping anything
+
+    alias_queue = RedisQueue("aliasqueue", myredis, consumer=consumer)
     # to clear alias_queue:
     #import redis, os
     #myredis = redis.from_url(os.getenv("REDISTOGO_URL"))
-    #myredis.delete(["aliasqueue"])
+    #myredis.delete(*alias_queue.keys)
 
 
     # these need to match the tiid alphabet defined in models:
     couch_queues = {}
     for i in "abcdefghijklmnopqrstuvwxyz1234567890":
-        couch_queues[i] = PythonQueue(i+"_couch_queue")
-        couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
-        couch_worker.spawn_and_loop() 
+        couch_queues[i] = RedisQueue(i+"_couch_queue", myredis, CouchMessage, consumer=consumer, 
+            on_dead_letter=on_dead_letter)
+        for worker_number in range(default_settings.COUCH_WORKERS_PER_QUEUE):
+            couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
+            couch_worker.spawn_and_loop() 
         logger.info("launched backend couch worker with {i}_couch_queue".format(
             i=i))
 
 
-    polling_interval = 0.1   # how many seconds between polling to talk to provider
+    # providers are throttled by their rate limiters now, so no need to sleep between messages
+    polling_interval = 0   # how many seconds between polling to talk to provider
     provider_queues = {}
+    provider_configs = dict(default_settings.PROVIDERS)
     providers = ProviderFactory.get_providers(default_settings.PROVIDERS)
     for provider in providers:
-        provider_queues[provider.provider_name] = PythonQueue(provider.provider_name+"_queue")
+        provider_config = provider_configs.get(provider.provider_name, {})
+        (max_threads, max_backlog) = provider_pool_sizes(provider_config)
+        provider.rate_limiter = ProviderRateLimiter(myredis, provider.provider_name, 
+            provider_config.get("rate", default_settings.PROVIDER_RATE),
+            provider_config.get("burst", default_settings.PROVIDER_BURST))
+        provider.health = ProviderHealth(provider.provider_name, max_threads, myredis)
+        provider_queues[provider.provider_name] = RedisFairQueue(provider.provider_name+"_queue", myredis, 
+            consumer=consumer, on_dead_letter=on_dead_letter)
         provider_worker = ProviderWorker(
             provider, 
             polling_interval, 
@@ -361,9 +1197,14 @@ def main():
             provider_queues[provider.provider_name], 
             couch_queues,
             ProviderWorker.wrapper,
-            myredis)
+            myredis,
+            max_threads=max_threads,
+            max_backlog=max_backlog)
         provider_worker.spawn_and_loop()
 
+    reaper.queues = [alias_queue] + couch_queues.values() + provider_queues.values()
+    reaper.spawn_and_loop()
+
     backend = Backend(alias_queue, provider_queues, couch_queues, myredis)
     try:
         backend.run_in_loop() # don't need to spawn this one
@@ -3,18 +3,101 @@ import pylibmc
 import hashlib
 import logging
 import json
+import threading
+import time
+import zlib
+import cPickle
+from collections import OrderedDict, defaultdict
 from cPickle import PicklingError
 
 from totalimpact.utils import Retry
+from totalimpact import default_settings
 
 # set up logging
 logger = logging.getLogger("ti.cache")
 
+# process-wide pool of memcached clients, filled on first use and shared by all threads
+memcached_pool = None
+memcached_pool_lock = threading.Lock()
+
+# hit and miss counts for each cache tier, see get_cache_stats()
+cache_stats = defaultdict(int)
+cache_stats_lock = threading.Lock()
+
+def count_cache_stat(stat_name, amount=1):
+    with cache_stats_lock:
+        cache_stats[stat_name] += amount
+
+def get_cache_stats():
+    with cache_stats_lock:
+        return dict(cache_stats)
+
+
+# Entries are pickled here, once, and stored as a string starting with one of these
+# markers, so pylibmc doesn't pickle them again.  That way the ones over the threshold
+# can be zlib'd here and the bytes it saves counted, which pylibmc's own compression
+# doesn't report.  Entries stored before this are returned as pylibmc gives them.
+PICKLED_FORMAT = "ti-pickle:"
+COMPRESSED_FORMAT = "ti-zlib-pickle:"
+
+def encode_entry(data, threshold):
+    pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+    if len(pickled) < threshold:
+        return PICKLED_FORMAT + pickled
+    compressed = zlib.compress(pickled)
+    count_cache_stat("compressed_entries")
+    count_cache_stat("compressed_bytes_saved", len(pickled) - len(compressed))
+    return COMPRESSED_FORMAT + compressed
+
+def decode_entry(entry):
+    if isinstance(entry, str):
+        if entry.startswith(COMPRESSED_FORMAT):
+            return cPickle.loads(zlib.decompress(entry[len(COMPRESSED_FORMAT):]))
+        if entry.startswith(PICKLED_FORMAT):
+            return cPickle.loads(entry[len(PICKLED_FORMAT):])
+    return entry
+
+
 class CacheException(Exception):
     pass
 
+
+class LruCache(object):
+    """ A thread-safe, size-limited, in-process cache whose entries expire """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                (expires_at, data) = self.entries.pop(key)
+            except KeyError:
+                return None
+            if time.time() >= expires_at:
+                return None
+            # put it back at the most-recently-used end
+            self.entries[key] = (expires_at, data)
+            return data
+
+    def set(self, key, data, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+# in-process tier in front of memcached, shared by all threads
+local_cache = LruCache(default_settings.LOCAL_CACHE_MAX_ENTRIES)
+
+
 class Cache(object):
-    """ Maintains a cache of URL responses in memcached """
+    """ Maintains a cache of URL responses in memcached, with recent ones also kept in-process """
 
     def _build_hash_key(self, key):
         json_key = json.dumps(key)
@@ -28,6 +111,16 @@ class Cache(object):
             password=os.environ.get('MEMCACHE_PASSWORD'),
             binary=True)
         return mc
+
+    def _get_memcached_pool(self):
+        global memcached_pool
+        if memcached_pool is None:
+            with memcached_pool_lock:
+                if memcached_pool is None:
+                    pool = pylibmc.ClientPool()
+                    pool.fill(self._get_memcached_client(), default_settings.MEMCACHE_POOL_SIZE)
+                    memcached_pool = pool
+        return memcached_pool
  
     def __init__(self, max_cache_age=86400):
         self.max_cache_age = max_cache_age
@@ -36,21 +129,47 @@ class Cache(object):
         #mc = self._get_memcached_client()        
         #mc.flush_all()
 
-    @Retry(3, pylibmc.Error, 0.1)
+    def _local_cache_age(self):
+        return min(self.max_cache_age, default_settings.LOCAL_CACHE_MAX_AGE)
+
     def get_cache_entry(self, key):
         """ Get an entry from the cache, returns None if not found """
-        mc = self._get_memcached_client()
         hash_key = self._build_hash_key(key)
-        response = mc.get(hash_key)
+
+        response = local_cache.get(hash_key)
+        if response:
+            count_cache_stat("local_hits")
+            return response
+        count_cache_stat("local_misses")
+
+        response = self._get_memcached_entry(hash_key)
+        if response:
+            count_cache_stat("memcached_hits")
+            local_cache.set(hash_key, response, self._local_cache_age())
+        else:
+            count_cache_stat("memcached_misses")
         return response
 
     @Retry(3, pylibmc.Error, 0.1)
-    def set_cache_entry(self, key, data):
-        """ Store a cache entry """
-        mc = self._get_memcached_client()
+    def _get_memcached_entry(self, hash_key):
+        with self._get_memcached_pool().reserve(block=True) as mc:
+            response = mc.get(hash_key)
+        return decode_entry(response)
+
+    def set_cache_entry(self, key, data, max_cache_age=None):
+        """ Store a cache entry, for max_cache_age seconds if given instead of the default """
+        if max_cache_age is None:
+            max_cache_age = self.max_cache_age
         hash_key = self._build_hash_key(key)
+        local_cache.set(hash_key, data, min(max_cache_age, self._local_cache_age()))
+        return self._set_memcached_entry(hash_key, data, max_cache_age)
+
+    @Retry(3, pylibmc.Error, 0.1)
+    def _set_memcached_entry(self, hash_key, data, max_cache_age):
         try:
-            set_response = mc.set(hash_key, data, time=self.max_cache_age)
+            entry = encode_entry(data, default_settings.CACHE_COMPRESSION_THRESHOLD)
+            with self._get_memcached_pool().reserve(block=True) as mc:
+                set_response = mc.set(hash_key, entry, time=max_cache_age)
             if not set_response:
                 raise CacheException("Unable to store into Memcached. Make sure memcached server is running.")
         except PicklingError:
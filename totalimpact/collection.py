@@ -89,8 +89,9 @@ def get_collection_with_items_for_client(cid, myrefsets, myredis, mydao):
                 collection["items"] += [item_for_client]
     
     something_currently_updating = False
-    for item in collection["items"]:
-        item["currently_updating"] = ItemFactory.is_currently_updating(item["_id"], myredis)
+    tiids = [item["_id"] for item in collection["items"]]
+    for (item, currently_updating) in zip(collection["items"], ItemFactory.are_currently_updating(tiids, myredis)):
+        item["currently_updating"] = currently_updating
         something_currently_updating = something_currently_updating or item["currently_updating"]
 
     logging.info("Got items for collection %s" %cid)
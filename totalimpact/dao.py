@@ -131,6 +131,26 @@ class Dao(object):
         logger.info("dao saved %s" %(doc["_id"]))
         return response
 
+
+    # these raise after the last retry, so callers can tell a couch
+    # failure apart from an empty result
+    @Retry(3, Exception, 0.1, reraise=True)
+    def get_many(self, ids):
+        # one _all_docs request; ids that aren't found are left out
+        rows = self.db.view("_all_docs", keys=ids, include_docs=True)
+        docs = dict([(row.key, row.doc) for row in rows if row.doc])
+        return docs
+
+    @Retry(3, Exception, 0.1, reraise=True)
+    def save_many(self, docs):
+        # one _bulk_docs request.  Returns a (success, docid, rev_or_exception) 
+        # tuple per doc; failures like conflicts are reported there, not raised
+        for doc in docs:
+            if "_id" not in doc:
+                raise KeyError("tried to save doc with '_id' key unset.")
+        response = self.db.update(docs)
+        logger.info("dao saved %i docs in bulk" %(len(docs)))
+        return response
        
     def view(self, viewname):
         return self.db.view(viewname)
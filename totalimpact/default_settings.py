@@ -3,16 +3,110 @@
 # ALL KEYS HAVE TO BE UPPERCASE TO BE STORED IN APP SETTINGS
 #
 
+import os
+
 USER_AGENT = "ImpactStory/0.4.0" # User-Agent string to use on HTTP requests
 VERSION = "cristhian" # version
 PROXY = "" # used with  providers-test-proxy.py script in the extras directory
 CACHE_ENABLED = True # Memcache server enabled
+MEMCACHE_POOL_SIZE = 20 # memcached clients shared by all threads in a process
+LOCAL_CACHE_MAX_ENTRIES = 1000 # responses also kept in-process, in front of memcached
+LOCAL_CACHE_MAX_AGE = 600 # seconds, or the provider's max_cache_duration if that is shorter
+CACHE_COMPRESSION_THRESHOLD = 10000 # bytes; bigger memcached entries are zlib compressed
+
+# Seconds to reuse cached non-200 provider responses, by status code or else by 
+# status class; 0 means always go live.  Providers can override with a 
+# negative_cache_durations attribute.
+NEGATIVE_CACHE_DURATIONS = {
+    "3xx": 0,
+    "4xx": 60*60*6,
+    # auth failures, timeouts and rate limiting pass, so don't hide the data behind them
+    "401": 0,
+    "403": 0,
+    "408": 0,
+    "429": 0,
+    "5xx": 0
+}
+
+# Each provider gets its own keep-alive HTTP session.  POOL_CONNECTIONS is how many 
+# hosts it keeps pools for, POOL_MAXSIZE how many open connections per host.
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+
+# Each provider worker runs its calls on a fixed pool of threads.  Once BACKLOG
+# popped messages are waiting for a free thread, the worker stops popping its queue.
+# Override per provider with "workers" and "backlog" in its PROVIDERS config dict.
+PROVIDER_WORKER_THREADS = 5
+PROVIDER_WORKER_BACKLOG = 20
+
+# "threads" or "gevent", set per deployment with the PROVIDER_ENGINE env variable.
+# gevent monkey-patches the backend so every provider call is a greenlet on one OS
+# thread, which makes thousands of in-flight provider requests cheap.
+PROVIDER_ENGINE = os.getenv("PROVIDER_ENGINE", "threads")
+PROVIDER_WORKER_GREENLETS = 100
+PROVIDER_WORKER_GREENLET_BACKLOG = 200
+
+# Live requests per second, and burst size, allowed to each provider.  The budget
+# is kept in redis so it is shared by all backend processes.  Override per 
+# provider with "rate" and "burst" in its PROVIDERS config dict.
+PROVIDER_RATE = 10
+PROVIDER_BURST = 20
+
+# Circuit breaker: stop calling a provider for COOLDOWN seconds once ERROR_RATE of 
+# its last WINDOW live requests were timeouts, connection errors or 5xx responses.
+PROVIDER_BREAKER_WINDOW = 20
+PROVIDER_BREAKER_ERROR_RATE = 0.5
+PROVIDER_BREAKER_COOLDOWN = 60
+# a provider's concurrency is halved whenever a live request fails or takes longer than this
+PROVIDER_LATENCY_TARGET = 5 # seconds
+
+# The backend router takes up to this many alias messages off redis at a time
+BACKEND_ALIAS_BATCH_SIZE = 500
+
+# Priority lanes, most urgent first.  Every backend queue hands out waiting work
+# from an earlier lane before a later one, so a single item added through the api
+# isn't stuck behind a big collection refresh.
+QUEUE_PRIORITIES = ["interactive", "collection-create", "scheduled-refresh"]
+# the lane for work queued without one, including anything queued before lanes existed
+DEFAULT_QUEUE_PRIORITY = "scheduled-refresh"
+
+# Within a lane, provider queues take turns between tenants: each collection
+# ("collection:<cid>"), and single items by the api key that added them ("key:<key>").
+# On its turn a tenant gets as many messages as its weight, so a big collection
+# queued first doesn't hold up everyone behind it.
+QUEUE_TENANT_WEIGHTS = {}  # eg {"key:SOMEKEY": 4}
+QUEUE_DEFAULT_TENANT_WEIGHT = 1
+
+# All the backend queues are in redis, shared by however many backend processes
+# are running.  A message that fails this many times, or is popped by this many
+# processes that die before finishing it, goes on the queue's dead letter list.
+QUEUE_MAX_ATTEMPTS = 5
+# An idle worker polls its queue, waiting twice as long between polls each time it 
+# finds nothing, up to this long.  Polling keeps each process down to a few redis 
+# connections, where blocking pops would hold one for every idle worker thread.
+REDIS_QUEUE_POLL_INTERVAL = 0.5 # seconds
+# Each backend process keeps a key alive in redis for this long, refreshed every third
+# of it.  Once a process's key expires, anything it popped but didn't finish is requeued.
+BACKEND_ALIVE_TTL = 60 # seconds
+# A backend worker whose run fails, say because redis is briefly unreachable, logs it
+# and waits before trying again: a second, then twice as long each time in a row, up to this.
+WORKER_ERROR_BACKOFF_MAX = 60 # seconds
+
+# Each couch worker takes up to this many waiting messages at a time, merges the
+# ones for the same item, and writes all the changed items in one bulk request.
+COUCH_WORKER_BATCH_SIZE = 100
+# An item saved by someone else since it was read is re-read, has the pending 
+# updates merged in again and is re-saved, up to this many times.  That makes it
+# safe to run more than one couch worker on the same items.
+COUCH_WORKER_CONFLICT_RETRIES = 5
+COUCH_WORKERS_PER_QUEUE = 1
 
 # List of desired providers and their configuration files
 # Alias methods will be called in the order of this list
 PROVIDERS = [
     # this is up here because it can produce dois
-    ("pubmed", {}),
+    # eutils asks for no more than 3 requests per second
+    ("pubmed", {"rate": 3, "burst": 3}),
 
     # best biblio providers go here, in order with best first
     ("crossref", {}),
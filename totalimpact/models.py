@@ -5,7 +5,7 @@ import shortuuid, datetime, hashlib, threading, json, time, copy
 from totalimpact.providers.provider import ProviderFactory
 from totalimpact.providers.provider import ProviderTimeout, ProviderServerError
 from totalimpact import default_settings
-from totalimpact.utils import Retry
+from totalimpact.utils import Retry, thaw
 
 # Master lock to ensure that only a single thread can write
 # to the DB at one time to avoid document conflicts
@@ -28,6 +28,11 @@ class ItemFactory():
     @classmethod
     def get_item(cls, tiid, myrefsets, dao):
         item_doc = dao.get(tiid)
+        return cls.item_from_doc(tiid, item_doc, myrefsets)
+
+    @classmethod
+    def item_from_doc(cls, tiid, item_doc, myrefsets):
+        # the item to send to the client, or None if there's no doc or it can't be built
         if not item_doc:
             return None
         try:
@@ -194,7 +199,8 @@ class ItemFactory():
     @classmethod
     def merge_alias_dicts(self, aliases1, aliases2):
         #logger.debug("in MERGE ALIAS DICTS with %s and %s" %(aliases1, aliases2))
-        merged_aliases = copy.deepcopy(aliases1)
+        # thaw makes a changeable deep copy, even of frozen aliases from queue messages
+        merged_aliases = thaw(aliases1)
         for ns, nid_list in aliases2.iteritems():
             for nid in nid_list:
                 try:
@@ -207,7 +213,7 @@ class ItemFactory():
     @classmethod
     def get_metric_names(self, providers_config):
         full_metric_names = []
-        providers = ProviderFactory.get_providers(providers_config)
+        providers = ProviderFactory.get_registry(providers_config).providers
         for provider in providers:
             metric_names = provider.metric_names()
             for metric_name in metric_names:
@@ -244,34 +250,34 @@ class ItemFactory():
 
     @classmethod
     def retrieve_items(cls, tiids, myrefsets, myredis, mydao):
+        # one couch request and one redis request for all the items.
+        # A couch failure raises, rather than looking like missing items
+        item_docs = mydao.get_many(tiids)
+        currently_updating_list = cls.are_currently_updating(tiids, myredis)
+
         something_currently_updating = False
         items = []
-        for tiid in tiids:
-            try:
-                item = cls.get_item(tiid, myrefsets, mydao)
-            except (LookupError, AttributeError), e:
-                logger.warning("Got an error looking up tiid '{tiid}'; error: {error}".format(
-                        tiid=tiid, error=e.__repr__()))
-                raise
-
+        for (tiid, currently_updating) in zip(tiids, currently_updating_list):
+            item = cls.item_from_doc(tiid, item_docs.get(tiid), myrefsets)
             if not item:
                 logger.warning("Looks like there's no item with tiid '{tiid}': ".format(
                         tiid=tiid))
                 raise LookupError
                 
-            item["currently_updating"] = cls.is_currently_updating(tiid, myredis)
+            item["currently_updating"] = currently_updating
             something_currently_updating = something_currently_updating or item["currently_updating"]
 
             items.append(item)
         return (items, something_currently_updating)
 
+    @classmethod
+    def are_currently_updating(cls, tiids, myredis):
+        # like is_currently_updating, with one MGET for all the tiids
+        return myredis.get_currently_updating_many(tiids)
+
     @classmethod
     def is_currently_updating(cls, tiid, myredis):
-        num_providers_left = myredis.get_num_providers_left(tiid)
-        if num_providers_left:
-            currently_updating = myredis.get_num_providers_left(tiid) > 0
-        else: # not in redis, maybe because it expired.  Assume it is not currently updating.
-            currently_updating = False        
+        [currently_updating] = myredis.get_currently_updating_many([tiid])
         return currently_updating
 
 
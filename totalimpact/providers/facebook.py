@@ -1,7 +1,7 @@
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError
 
-import simplejson
+import simplejson, urllib
 import re
 
 import logging
@@ -15,6 +15,14 @@ class Facebook(Provider):
     descr = "A social networking service."
     metrics_url_template = "http://api.facebook.com/restserver.php?method=links.getStats&urls=%s"
     provenance_url_template = ""
+    metrics_batch_size = 20
+
+    metrics_dict_of_keylists = {
+        'facebook:likes' : ['share_count'],
+        'facebook:shares' : ['like_count'],
+        'facebook:comments' : ['comment_count'],
+        'facebook:clicks' : ['click_count']
+    }
 
     static_meta_dict =  {
         "likes": {
@@ -66,17 +74,84 @@ class Facebook(Provider):
         if not "links_getStats_response" in page:
             raise ProviderContentMalformedError
 
-        dict_of_keylists = {
-            'facebook:likes' : ['share_count'],
-            'facebook:shares' : ['like_count'],
-            'facebook:comments' : ['comment_count'],
-            'facebook:clicks' : ['click_count']
-        }
-
-        metrics_dict = provider._extract_from_xml(page, dict_of_keylists)
+        metrics_dict = provider._extract_from_xml(page, self.metrics_dict_of_keylists)
 
         return metrics_dict
 
+    # links.getStats takes a comma-separated list of urls
+    def _get_metrics_for_ids(self, 
+            ids, 
+            provider_url_template=None, 
+            cache_enabled=True):
+
+        if not provider_url_template:
+            provider_url_template = self.metrics_url_template
+        # quote each url on its own so the separating commas stay unquoted
+        urls_string = ",".join([urllib.quote(id) for id in ids])
+        url = provider_url_template % urls_string
+
+        response = self.http_get(url, cache_enabled=cache_enabled, allow_redirects=True)
+        try:
+            metrics_by_id = self._extract_metrics_for_ids(response.text, response.status_code, ids)
+        except (AttributeError, TypeError):
+            metrics_by_id = {}
+        return metrics_by_id
+
+    def _normalize_url(self, url):
+        # facebook may hand back the url with a different scheme, host case or trailing slash
+        url = re.sub("^https?://(www\.)?", "", url.strip().lower())
+        return url.rstrip("/")
+
+    def _extract_metrics_for_ids(self, page, status_code=200, ids=None):
+        if status_code != 200:
+            if status_code == 404:
+                return {}
+            else:
+                raise(self._get_error(status_code))
+
+        if not "links_getStats_response" in page:
+            raise ProviderContentMalformedError
+
+        (doc, lookup_function) = provider._get_doc_from_xml(page)
+        if lookup_function == provider._lookup_xml_from_dom:
+            link_stats = doc.getElementsByTagName("link_stat")
+        else:
+            link_stats = doc.findAll("link_stat")
+
+        if ids is None:
+            ids = [lookup_function(link_stat, ["url"]) for link_stat in link_stats]
+
+        # there is one link_stat per requested url, in request order, but the 
+        # returned url isn't always the one asked for, so match by position 
+        # and only fall back to the normalized url if the counts differ
+        if len(link_stats) == len(ids):
+            ids_and_link_stats = zip(ids, link_stats)
+        else:
+            ids_by_normalized_url = dict([(self._normalize_url(id), id) for id in ids])
+            ids_and_link_stats = []
+            for link_stat in link_stats:
+                returned_url = lookup_function(link_stat, ["url"]) or ""
+                normalized_url = self._normalize_url(returned_url)
+                if normalized_url in ids_by_normalized_url:
+                    ids_and_link_stats.append((ids_by_normalized_url[normalized_url], link_stat))
+                else:
+                    logger.warning("%20s no requested url matches returned url %s" % (self.provider_name, returned_url))
+
+        metrics_by_id = {}
+        for (id, link_stat) in ids_and_link_stats:
+            metrics_dict = {}
+            for (metric, keylist) in self.metrics_dict_of_keylists.iteritems():
+                value = lookup_function(link_stat, keylist)
+                # only set metrics for non-zero and non-null metrics
+                if value:
+                    metrics_dict[metric] = value
+            metrics_by_id[id] = metrics_dict
+
+        missing_ids = [id for id in ids if id not in metrics_by_id]
+        if missing_ids:
+            logger.warning("%20s no metrics returned for %s" % (self.provider_name, missing_ids))
+        return metrics_by_id
+
     def provenance_url(self, metric_name, aliases):
         # facebook has no provenance_url
         return ""
@@ -6,8 +6,9 @@ from totalimpact import providers
 from totalimpact import default_settings
 from totalimpact import utils
 
-import requests, os, time, threading, sys, traceback, importlib, urllib, logging, itertools
+import requests, redis, os, time, threading, sys, traceback, importlib, urllib, logging, itertools, collections
 import simplejson
+from requests.packages.urllib3.poolmanager import PoolManager
 import BeautifulSoup
 from xml.dom import minidom 
 from xml.parsers.expat import ExpatError
@@ -18,8 +19,201 @@ logger = logging.getLogger("ti.provider")
 # Requests' logging is too noisy
 requests_log = logging.getLogger("requests").setLevel(logging.WARNING) 
 
+# one keep-alive connection pool per provider, shared by all the threads calling that provider.
+# Sessions aren't thread-safe, so each thread gets its own session on top of the shared pool.
+http_pools = {}
+http_pools_lock = threading.Lock()
+http_sessions = threading.local()
+
+def get_http_pool(provider_name):
+    from totalimpact import app
+    with http_pools_lock:
+        if provider_name not in http_pools:
+            http_pools[provider_name] = PoolManager(
+                num_pools=app.config["HTTP_POOL_CONNECTIONS"],
+                maxsize=app.config["HTTP_POOL_MAXSIZE"])
+        return http_pools[provider_name]
+
+def get_http_session(provider_name):
+    sessions = getattr(http_sessions, "by_provider", None)
+    if sessions is None:
+        sessions = http_sessions.by_provider = {}
+    if provider_name not in sessions:
+        # don't keep cookies, so one call's cookies aren't sent with the next
+        session = requests.session(config={
+            "keep_alive": True,
+            "store_cookies": False
+            })
+        session.poolmanager = get_http_pool(provider_name)
+        sessions[provider_name] = session
+    return sessions[provider_name]
+
+def http_session_stats(provider_name):
+    """ Returns {host: {"connections":, "requests":, "reused":}} for a provider's connection pool """
+    stats = {}
+    try:
+        pools = http_pools[provider_name].pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            stats[pool.host] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+                "reused": pool.num_requests - pool.num_connections
+                }
+    except (KeyError, AttributeError):
+        pass
+    return stats
+
+class InFlightRequests(object):
+    """ Lets concurrent callers with the same key wait on one call and share its result """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"done": threading.Event()}
+                self.calls[key] = call
+
+        if not is_leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+        except Exception, e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+        return call["result"]
+
+    def __len__(self):
+        return len(self.calls)
+
+in_flight_requests = InFlightRequests()
+
+
+def run_concurrently(*funcs, **kwargs):
+    """ Calls each func on its own thread and returns their results in order.
+
+    Given a pool (the backend's ProviderThreadPool), each extra thread takes one 
+    of the pool's free slots, so the provider's concurrency limit still holds; 
+    funcs that can't get a slot run one after another on this thread instead.
+    Re-raises the first exception, after all the calls have finished.
+    """
+    pool = kwargs.get("pool")
+    results = [None for func in funcs]
+    errors = [None for func in funcs]
+
+    def call(i, func):
+        try:
+            results[i] = func()
+        except Exception, e:
+            errors[i] = e
+
+    def call_in_slot(i, func):
+        try:
+            call(i, func)
+        finally:
+            pool.release_slot()
+
+    threads = []
+    funcs_for_this_thread = [(0, funcs[0])] if funcs else []
+    for (i, func) in enumerate(funcs[1:], 1):
+        if pool is None:
+            threads.append(threading.Thread(target=call, args=(i, func)))
+        elif pool.try_take_slot():
+            threads.append(threading.Thread(target=call_in_slot, args=(i, func)))
+        else:
+            funcs_for_this_thread.append((i, func))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # the first func, and any that didn't get a slot, run on this thread
+    for (i, func) in funcs_for_this_thread:
+        call(i, func)
+    for t in threads:
+        t.join()
+
+    for error in errors:
+        if error:
+            raise error
+    return results
+
+
+class ProviderRateLimiter(object):
+    """ Blocks until the provider's redis token bucket lets another request through """
+
+    def __init__(self, myredis, provider_name, rate, burst):
+        self.myredis = myredis
+        self.provider_name = provider_name
+        self.rate = rate
+        self.burst = burst
+
+    def wait(self):
+        while True:
+            try:
+                wait_seconds = self.myredis.take_rate_limit_token(self.provider_name, self.rate, self.burst)
+            except redis.RedisError, e:
+                # don't stop calling the provider just because redis is having trouble
+                logger.warning("%s rate limiter couldn't reach redis: %s" % (self.provider_name, e.__repr__()))
+                return
+            if not wait_seconds:
+                return
+            time.sleep(wait_seconds)
+
+
+class ProviderRegistry(object):
+    """ Provider instances for one providers config, and what they provide, worked out once.
+
+    Get one through ProviderFactory.get_registry, which keeps one per config.
+    """
+
+    def __init__(self, config_providers):
+        self.providers = ProviderFactory.get_providers(config_providers)
+        self.providers_by_name = dict([(provider.provider_name, provider) for provider in self.providers])
+
+        self.provider_names_by_capability = {}
+        for capability in ["members", "aliases", "biblio", "metrics", "static_meta"]:
+            self.provider_names_by_capability[capability] = [provider.provider_name 
+                for provider in self.providers if getattr(provider, "provides_"+capability)]
+
+        self.all_static_meta = {}
+        for provider in self.providers:
+            if provider.provides_metrics:
+                for metric_name in provider.static_meta_dict:
+                    full_metric_name = provider.provider_name + ":" + metric_name
+                    self.all_static_meta[full_metric_name] = provider.static_meta_dict[metric_name]
+
+    def get_provider(self, provider_name):
+        return self.providers_by_name[provider_name]
+
+    def get_provider_names(self, filter_by=None):
+        if filter_by is None:
+            return [provider.provider_name for provider in self.providers]
+        return list(self.provider_names_by_capability[filter_by])
+
+    def num_providers(self, filter_by=None):
+        return len(self.get_provider_names(filter_by))
+
+    def get_metric_names(self):
+        return self.all_static_meta.keys()
+
+
 class ProviderFactory(object):
 
+    registries = {}
+    registries_lock = threading.Lock()
+
     @classmethod
     def get_provider(cls, provider_name):
         provider_module = importlib.import_module('totalimpact.providers.'+provider_name)
@@ -45,37 +239,36 @@ class ProviderFactory(object):
                 logger.error("Unable to configure provider ... skipping " + str(v))
         return providers
 
+    @classmethod
+    def get_registry(cls, config_providers=default_settings.PROVIDERS):
+        # built the first time each config is asked for, then shared
+        key = simplejson.dumps(config_providers, sort_keys=True)
+        registry = cls.registries.get(key)
+        if registry is None:
+            with cls.registries_lock:
+                registry = cls.registries.get(key)
+                if registry is None:
+                    registry = ProviderRegistry(config_providers)
+                    cls.registries[key] = registry
+        return registry
+
     @classmethod
     def num_providers_with_metrics(cls, config_providers):
-        providers = cls.get_providers(config_providers)
-        num_providers_with_metrics = 0
-        for provider in providers:
-            if provider.provides_metrics:
-                num_providers_with_metrics += 1
-        return num_providers_with_metrics
+        return cls.get_registry(config_providers).num_providers("metrics")
 
     @classmethod
     def get_all_static_meta(cls, config_providers=default_settings.PROVIDERS):
-        # this is now duplicating get_all_metadata below; not high refactoring priority, though.
-        all_static_meta = {}
-        providers = cls.get_providers(config_providers)
-        for provider in providers:
-            if provider.provides_metrics:
-                for metric_name in provider.static_meta_dict:
-                    full_metric_name = provider.provider_name + ":" + metric_name
-                    all_static_meta[full_metric_name] = provider.static_meta_dict[metric_name]
-        return(all_static_meta)
+        return(dict(cls.get_registry(config_providers).all_static_meta))
 
     @classmethod
     def get_all_metric_names(cls, config_providers=default_settings.PROVIDERS):
-        all_static_meta = cls.get_all_static_meta(config_providers)
-        metric_names = all_static_meta.keys()
+        metric_names = cls.get_registry(config_providers).get_metric_names()
         return(metric_names)
 
     @classmethod
     def get_all_metadata(cls, config_providers=default_settings.PROVIDERS):
         ret = {}
-        providers = cls.get_providers(config_providers)
+        providers = cls.get_registry(config_providers).providers
         for provider in providers:
             provider_data = {}
             provider_data["provides_metrics"] = provider.provides_metrics
@@ -95,9 +288,154 @@ class ProviderFactory(object):
         return ret
 
 
+class ProviderHealth(object):
+    """ Circuit breaker and AIMD concurrency limit for one provider, fed by its live requests.
+
+    The breaker opens when too many of the recent requests failed (timeouts, connection 
+    errors, 5xx), rejects requests for a cooldown, then lets one trial request through
+    and closes again if it succeeds.  The concurrency limit is halved on every failure 
+    or slow response and grows back by about one per round of successes.
+    """
+
+    def __init__(self, provider_name, max_concurrency, myredis=None, process_name=None,
+            window=default_settings.PROVIDER_BREAKER_WINDOW,
+            error_rate=default_settings.PROVIDER_BREAKER_ERROR_RATE,
+            cooldown=default_settings.PROVIDER_BREAKER_COOLDOWN,
+            latency_target=default_settings.PROVIDER_LATENCY_TARGET):
+        self.provider_name = provider_name
+        self.max_concurrency = max_concurrency
+        self.myredis = myredis
+        if process_name is None:
+            process_name = utils.process_name()
+        self.process_name = process_name
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.latency_target = latency_target
+
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = "closed"
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trial_started_at = None
+        self.limit = float(max_concurrency)
+        self.last_latency = None
+        self.last_published = 0
+        self.publish_due = False
+
+    def allow_request(self):
+        with self.lock:
+            allowed = self._allow_request()
+            health = self._health_to_publish(periodically=False)
+        self.publish(health)
+        return allowed
+
+    def _allow_request(self):
+        # call holding the lock
+        if self.state == "closed":
+            return True
+        if self.state == "open" and (time.time() - self.opened_at >= self.cooldown):
+            self._set_state("half_open")
+        if self.state == "half_open":
+            # a trial request that never reported back doesn't hold things up forever
+            if (not self.trial_in_flight) or (time.time() - self.trial_started_at >= self.cooldown):
+                self.trial_in_flight = True
+                self.trial_started_at = time.time()
+                return True
+        return False
+
+    def record(self, latency, is_error):
+        with self.lock:
+            self._record(latency, is_error)
+            health = self._health_to_publish()
+        self.publish(health)
+
+    def _record(self, latency, is_error):
+        # call holding the lock
+        self.last_latency = latency
+        if is_error or (latency > self.latency_target):
+            self.limit = max(1.0, self.limit / 2)
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+        if self.state == "half_open":
+            self.trial_in_flight = False
+            if is_error:
+                self._open()
+            else:
+                self.outcomes.clear()
+                self._set_state("closed")
+            return
+
+        self.outcomes.append(is_error)
+        if len(self.outcomes) == self.outcomes.maxlen:
+            recent_error_rate = float(sum(self.outcomes)) / len(self.outcomes)
+            if recent_error_rate >= self.error_rate:
+                self._open()
+
+    def concurrency_limit(self):
+        return int(self.limit)
+
+    def _open(self):
+        self.opened_at = time.time()
+        self.outcomes.clear()
+        self._set_state("open")
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("%s circuit breaker going from %s to %s" % (self.provider_name, self.state, state))
+        self.state = state
+        self.publish_due = True
+
+    def _health_to_publish(self, periodically=True):
+        # call holding the lock.  A snapshot if the state changed, or every 10 seconds
+        if self.publish_due or (periodically and (time.time() - self.last_published > 10)):
+            self.publish_due = False
+            self.last_published = time.time()
+            return self.state_dict()
+        return None
+
+    def state_dict(self):
+        return {
+            "state": self.state,
+            "opened_at": self.opened_at,
+            "concurrency_limit": self.concurrency_limit(),
+            "max_concurrency": self.max_concurrency,
+            "last_latency": self.last_latency,
+            "recent_errors": sum(self.outcomes),
+            "recent_requests": len(self.outcomes),
+            "published_at": time.time()
+        }
+
+    def publish(self, health):
+        # so the web app, and anyone else looking at redis, can see how the provider is doing.
+        # Called without the lock held, so a slow redis doesn't hold up requests.
+        if (not self.myredis) or (health is None):
+            return
+        try:
+            self.myredis.set_provider_health(self.provider_name, self.process_name, health)
+        except redis.RedisError, e:
+            logger.warning("%s couldn't publish provider health: %s" % (self.provider_name, e.__repr__()))
+
+
         
 class Provider(object):
 
+    # overrides for NEGATIVE_CACHE_DURATIONS, eg {"4xx": 60*60}
+    negative_cache_durations = {}
+
+    # max ids per request, for providers that have _get_metrics_for_ids, 
+    # _get_biblio_for_ids or their own aliases_batch
+    metrics_batch_size = 20
+    biblio_batch_size = 20
+    aliases_batch_size = 20
+
+    # a ProviderRateLimiter, a ProviderHealth and the ProviderThreadPool, set by the 
+    # backend; live requests aren't limited or tracked without them
+    rate_limiter = None
+    health = None
+    pool = None
+
     def __init__(self, 
             max_cache_duration=86400, 
             max_retries=0, 
@@ -180,6 +518,19 @@ class Provider(object):
     def provides_static_meta(self):
          return ("static_meta_dict" in dir(self))
 
+    @property
+    def provides_metrics_batch(self):
+         return ("_get_metrics_for_ids" in dir(self))
+
+    @property
+    def provides_biblio_batch(self):
+         return ("_get_biblio_for_ids" in dir(self))
+
+    # providers that override aliases_batch override this too
+    @property
+    def provides_aliases_batch(self):
+         return False
+
 
     # default method; providers can override    
     def metric_names(self):
@@ -305,6 +656,50 @@ class Provider(object):
 
         return biblio_dict
 
+    # default method; providers can override
+    def biblio_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        """ Like calling biblio() on each list of aliases, but using multi-id 
+            requests for providers that have _get_biblio_for_ids.
+
+            Returns a list of biblio dicts in the same order as list_of_aliases. """
+
+        if not self.provides_biblio_batch:
+            return [self.biblio(aliases, provider_url_template, cache_enabled) 
+                    for aliases in list_of_aliases]
+
+        ids = [self.get_best_id(aliases) for aliases in list_of_aliases]
+        unique_ids = sorted(set([id for id in ids if id]))
+
+        biblio_by_id = {}
+        for i in range(0, len(unique_ids), self.biblio_batch_size):
+            ids_in_batch = unique_ids[i:i+self.biblio_batch_size]
+            self.logger.debug("%s getting biblio for %i ids at once" % (self.provider_name, len(ids_in_batch)))
+            biblio_by_id.update(self._get_biblio_for_ids(ids_in_batch, provider_url_template, cache_enabled))
+
+        # same as biblio(), None for items without a relevant id
+        responses = []
+        for id in ids:
+            if id:
+                responses.append(biblio_by_id.get(id, {}))
+            else:
+                responses.append(None)
+        return responses
+
+    # default method; providers can override
+    def aliases_batch(self, 
+            list_of_aliases, 
+            provider_url_template=None,
+            cache_enabled=True):
+        """ Like calling aliases() on each list of aliases.  Providers that can
+            look up many items at once override this and provides_aliases_batch.
+
+            Returns a list of alias lists in the same order as list_of_aliases. """
+        return [self.aliases(aliases, provider_url_template, cache_enabled) 
+                for aliases in list_of_aliases]
+
     # default method; providers can override
     def aliases(self, 
             aliases, 
@@ -390,12 +785,45 @@ class Provider(object):
             provider_url_template = self.metrics_url_template
 
         metrics = self.get_metrics_for_id(id, provider_url_template, cache_enabled)
+        metrics_and_drilldown = self._add_drilldown_urls(metrics, aliases)
+
+        return metrics_and_drilldown  
+
+    def _add_drilldown_urls(self, metrics, aliases):
         metrics_and_drilldown = {}
         for metric_name in metrics:
             drilldown_url = self.provenance_url(metric_name, aliases)
             metrics_and_drilldown[metric_name] = (metrics[metric_name], drilldown_url)
+        return metrics_and_drilldown
 
-        return metrics_and_drilldown  
+    # default method; providers can override
+    def metrics_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        """ Like calling metrics() on each list of aliases, but using multi-id 
+            requests for providers that have _get_metrics_for_ids.
+
+            Returns a list of metrics dicts in the same order as list_of_aliases. """
+
+        if not self.provides_metrics_batch:
+            return [self.metrics(aliases, provider_url_template, cache_enabled) 
+                    for aliases in list_of_aliases]
+
+        ids = [self.get_best_id(aliases) for aliases in list_of_aliases]
+        unique_ids = sorted(set([id for id in ids if id]))
+
+        metrics_by_id = {}
+        for i in range(0, len(unique_ids), self.metrics_batch_size):
+            ids_in_batch = unique_ids[i:i+self.metrics_batch_size]
+            self.logger.debug("%s getting metrics for %i ids at once" % (self.provider_name, len(ids_in_batch)))
+            metrics_by_id.update(self._get_metrics_for_ids(ids_in_batch, provider_url_template, cache_enabled))
+
+        responses = []
+        for (aliases, id) in zip(list_of_aliases, ids):
+            metrics = metrics_by_id.get(id, {})
+            responses.append(self._add_drilldown_urls(metrics, aliases))
+        return responses
 
 
     # default method; providers can override
@@ -429,6 +857,19 @@ class Provider(object):
 
     # Core methods
     # These should be consistent for all providers
+
+    def _negative_cache_duration(self, status_code):
+        """ How many seconds a response with this non-200 status code can be reused for """
+        from totalimpact import app
+        status_class = "%ixx" % (status_code / 100)
+        durations = dict(app.config["NEGATIVE_CACHE_DURATIONS"])
+        durations.update(self.negative_cache_durations)
+        duration = durations.get(str(status_code), durations.get(status_class, 0))
+        return min(duration, self.max_cache_duration)
+
+    def run_concurrently(self, *funcs):
+        """ run_concurrently, within this provider's share of the backend's threads """
+        return run_concurrently(*funcs, pool=self.pool)
     
     def http_get(self, url, headers=None, timeout=20, cache_enabled=True, allow_redirects=False):
         """ Returns a requests.models.Response object or raises exception
@@ -441,6 +882,7 @@ class Provider(object):
         use_cache = app.config["CACHE_ENABLED"] and cache_enabled
 
         cache_data = None
+        c = None
         if headers:
             cache_key = headers.copy()
         else:
@@ -458,41 +900,74 @@ class Provider(object):
                 # Return a stripped down equivalent of requests.models.Response
                 # We don't store headers or other information here. If we need
                 # that later, we can add it
-                # use it if it was a 200, otherwise go get it again
-                if (r.status_code == 200):
+                # use it if it was a 200 or a recent enough error, otherwise go get it again
+                cache_age = time.time() - cache_data.get('cached_at', 0)
+                if (r.status_code == 200) or (cache_age < self._negative_cache_duration(r.status_code)):
                     r.url = cache_data['url']
                     r.text = cache_data['text']
                     self.logger.debug("returning from cache: %s" %(url))
                     return r
             
+        # only one thread goes live for a given request; any others asking for 
+        # the same thing at the same time wait for it and share its response
+        in_flight_key = simplejson.dumps(cache_key, sort_keys=True)
+        return in_flight_requests.do(in_flight_key,
+            lambda: self._http_get_live(url, headers, timeout, allow_redirects, cache_key, c))
+
+    def _record_health(self, start_time, is_error):
+        if self.health:
+            self.health.record(time.time() - start_time, is_error)
+
+    def _http_get_live(self, url, headers, timeout, allow_redirects, cache_key, c=None):
+        from totalimpact import app
+
         # ensure that a user-agent string is set
         if headers is None:
             headers = {}
         headers["User-Agent"] = app.config["USER_AGENT"]
         
+        if self.health and not self.health.allow_request():
+            raise ProviderCircuitOpenError("Not calling provider while its circuit breaker is open, GET on " + url)
+
         # make the request        
+        start_time = time.time()
         try:
-            from totalimpact import app
             proxies = None
             if app.config["PROXY"]:
                 proxies = {'http' : app.config["PROXY"], 'https' : app.config["PROXY"]}
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+                start_time = time.time()
             self.logger.debug("LIVE %s" %(url))
-            r = requests.get(url, headers=headers, timeout=timeout, proxies=proxies, allow_redirects=allow_redirects, verify=False)
+            session = get_http_session(self.provider_name)
+            r = session.get(url, headers=headers, timeout=timeout, proxies=proxies, allow_redirects=allow_redirects, verify=False)
         except requests.exceptions.Timeout as e:
+            self._record_health(start_time, is_error=True)
             self.logger.info("%s Attempt to connect to provider timed out during GET on %s" %(self.provider_name, url))
             raise ProviderTimeout("Attempt to connect to provider timed out during GET on " + url, e)
         except requests.exceptions.RequestException as e:
+            self._record_health(start_time, is_error=True)
             raise ProviderHttpError("RequestException during GET on: " + url, e)
+        self._record_health(start_time, is_error=(r.status_code >= 500))
 
         if not r.encoding:
             r.encoding = "utf-8"            
+
+        # read the body now, so threads sharing this response don't race to read it
+        r.content
         
         # cache the response and return
-        if r and use_cache:
-            cache_data = {'text' : r.text, 
-                'status_code' : r.status_code, 
-                'url': r.url}
-            c.set_cache_entry(cache_key, cache_data)
+        if c:
+            if r.status_code == 200:
+                cache_duration = self.max_cache_duration
+            else:
+                cache_duration = self._negative_cache_duration(r.status_code)
+            if cache_duration > 0:
+                cache_data = {'text' : r.text, 
+                    'status_code' : r.status_code, 
+                    'url': r.url,
+                    'cached_at': time.time()}
+                c.set_cache_entry(cache_key, cache_data, cache_duration)
         return r
 
 
@@ -549,6 +1024,9 @@ class ProviderValidationFailedError(ProviderError):
 class ProviderRateLimitError(ProviderError):
     pass
 
+class ProviderCircuitOpenError(ProviderError):
+    pass
+
 def _load_json(page):
     try:
         data = simplejson.loads(page) 
@@ -1,11 +1,17 @@
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError
+from totalimpact.cache import LruCache
+from totalimpact import default_settings
 
-import simplejson, urllib, os, itertools
+import simplejson, urllib, os, itertools, re
 
 import logging
 logger = logging.getLogger('ti.providers.pubmed')
 
+# filtered pmids from the latest metrics lookups, keyed by (pmid, publication type), 
+# so the provenance urls built right after don't redo the same eutils calls
+filtered_pmids_memo = LruCache(default_settings.LOCAL_CACHE_MAX_ENTRIES)
+
 class Pubmed(Provider):  
 
     example_id = ("pmid", "22855908")
@@ -23,9 +29,18 @@ class Pubmed(Provider):
 
     aliases_from_doi_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?term=%s&email=team@total-impact.org&tool=total-impact" 
     aliases_from_pmid_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s&retmode=xml&email=team@total-impact.org&tool=total-impact" 
+    aliases_from_dois_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term=%s&retmax=%i&email=team@total-impact.org&tool=total-impact" 
 
     aliases_pubmed_url_template = "http://www.ncbi.nlm.nih.gov/pubmed/%s"
 
+    # elink, entrez2pmcciting and efetch all take comma-separated pmids
+    metrics_batch_size = 100
+    biblio_batch_size = 200
+    aliases_batch_size = 200
+    # esearch takes the dois in the query string of a GET, and a few 
+    # hundred of them make the url too long (414), so search in fewer at a time
+    dois_batch_size = 30
+
     biblio_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s&retmode=xml&email=team@total-impact.org&tool=total-impact" 
 
     static_meta_dict = {
@@ -78,6 +93,11 @@ class Pubmed(Provider):
     def provides_metrics(self):
         return True
 
+    # overriding default because overriding aliases_batch method
+    @property
+    def provides_aliases_batch(self):
+        return True
+
     def _extract_biblio(self, page, id=None):
         dict_of_keylists = {"year": ["PubmedArticleSet", "MedlineCitation", "Article", "Journal", "PubDate", "Year"], 
                             "title": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleTitle"],
@@ -169,6 +189,101 @@ class Pubmed(Provider):
 
         return new_aliases_unique
 
+    # efetch returns one PubmedArticle per pmid, in no guaranteed order.  
+    # Wrap each in its own PubmedArticleSet so the single-pmid extractors work on it.
+    def _split_pubmed_article_set(self, page):
+        if not page:
+            return {}
+        (doc, lookup_function) = provider._get_doc_from_xml(page)
+        pages_by_pmid = {}
+        try:
+            for article_dom in doc.getElementsByTagName("PubmedArticle"):
+                citation_dom = article_dom.getElementsByTagName("MedlineCitation")[0]
+                pmid = citation_dom.getElementsByTagName("PMID")[0].firstChild.data
+                pages_by_pmid[pmid] = "<PubmedArticleSet>" + article_dom.toxml() + "</PubmedArticleSet>"
+        except (IndexError, AttributeError, TypeError):
+            logger.warning("%20s unexpected PubmedArticle xml in efetch page" % (self.provider_name))            
+        return pages_by_pmid
+
+    def _get_efetch_pages(self, pmids, cache_enabled=True):
+        pages_by_pmid = {}
+        for i in range(0, len(pmids), self.aliases_batch_size):
+            pmids_string = ",".join(pmids[i:i+self.aliases_batch_size])
+            url = self.aliases_from_pmid_url_template %pmids_string
+            page = self._get_eutils_page(pmids_string, url, cache_enabled)
+            pages_by_pmid.update(self._split_pubmed_article_set(page))
+        return pages_by_pmid
+
+    # one esearch per batch of dois, then match the pmids it finds back to 
+    # the dois in their efetch pages
+    def _get_pmids_for_dois(self, dois, cache_enabled=True):
+        pmids_by_doi = {}
+        dois_by_lowercase = dict([(doi.lower(), doi) for doi in dois])
+        for i in range(0, len(dois), self.dois_batch_size):
+            dois_in_batch = dois[i:i+self.dois_batch_size]
+            query_string = " OR ".join([doi + "[doi]" for doi in dois_in_batch])
+            url = self.aliases_from_dois_url_template %(urllib.quote(query_string), len(dois_in_batch))
+            page = self._get_eutils_page(",".join(dois_in_batch), url, cache_enabled)
+            if not page:
+                continue
+            (doc, lookup_function) = provider._get_doc_from_xml(page)
+            try:
+                pmids = [id_doc.firstChild.data for id_doc in doc.getElementsByTagName("Id")]
+            except (AttributeError, TypeError):
+                logger.warning("%20s no Id xml tags for dois" % (self.provider_name))
+                pmids = []
+
+            for (pmid, pmid_page) in self._get_efetch_pages(pmids, cache_enabled).iteritems():
+                for (namespace, doi) in self._extract_aliases_from_pmid(pmid_page, pmid):
+                    if doi.lower() in dois_by_lowercase:
+                        pmids_by_doi[dois_by_lowercase[doi.lower()]] = pmid
+        return pmids_by_doi
+
+    def aliases_batch(self, 
+            list_of_aliases, 
+            provider_url_template=None,
+            cache_enabled=True):            
+
+        all_aliases = [alias for aliases in list_of_aliases for alias in aliases]
+        dois = sorted(set([nid for (namespace, nid) in all_aliases if namespace=="doi"]))
+        pmids = sorted(set([nid for (namespace, nid) in all_aliases if namespace=="pmid"]))
+        logger.debug("%20s getting aliases for %i dois and %i pmids" % (self.provider_name, len(dois), len(pmids)))
+
+        pmids_by_doi = self._get_pmids_for_dois(dois, cache_enabled)
+        pages_by_pmid = self._get_efetch_pages(pmids, cache_enabled)
+
+        responses = []
+        for aliases in list_of_aliases:
+            new_aliases = []
+            for alias in aliases:
+                (namespace, nid) = alias
+                if (namespace == "doi") and (nid in pmids_by_doi):
+                    new_aliases += [("pmid", pmids_by_doi[nid])]
+                if (namespace == "pmid"):
+                    page = pages_by_pmid.get(nid)
+                    if page:
+                        new_aliases += self._extract_aliases_from_pmid(page, nid)
+                        biblio = self._extract_biblio(page, nid)
+                        if biblio:
+                            new_aliases += [("biblio", biblio)]
+                    new_aliases += [("url", self.aliases_pubmed_url_template %nid)] 
+
+            # get uniques for things that are unhashable
+            new_aliases_unique = [k for k,v in itertools.groupby(sorted(new_aliases))]
+            responses.append(new_aliases_unique)
+
+        return responses
+
+    def _get_biblio_for_ids(self, 
+            ids, 
+            provider_url_template=None, 
+            cache_enabled=True):
+        pages_by_pmid = self._get_efetch_pages(ids, cache_enabled)
+        biblio_by_id = {}
+        for (pmid, page) in pages_by_pmid.iteritems():
+            biblio_by_id[pmid] = self._extract_biblio(page, pmid)
+        return biblio_by_id
+
     def _filter(self, id, citing_pmcids, filter_ptype):
         pmcids_string = " OR ".join(["PMC"+pmcid for pmcid in citing_pmcids])
         query_string = filter_ptype + "[ptyp] AND (" + pmcids_string + ")"
@@ -186,41 +301,83 @@ class Pubmed(Provider):
     def _check_reviewed_by_f1000(self, id, cache_enabled):
         metrics_f1000_url = self.metrics_f1000_url_template %id
         page = self._get_eutils_page(id, metrics_f1000_url)
+        return self._extract_reviewed_by_f1000(page, id)
+
+    def _extract_reviewed_by_f1000(self, page, id):
         f1000_url = "http://f1000.com/pubmed/%s" %id
-        if (f1000_url in page):
+        # so that a page for pmid 1234 doesn't match pmid 12345 in a batch
+        if re.search(re.escape(f1000_url) + r"(?!\d)", page):
             reviewed_by_f1000 = "Yes"
         else:
             reviewed_by_f1000 = 0
         return reviewed_by_f1000
 
-    # override because multiple pages to get
-    def get_metrics_for_id(self, 
-            id, 
-            provider_url_template=None, 
-            cache_enabled=True):
-
-        logger.debug("%20s getting metrics for %s" % (self.provider_name, id))
+    def _metrics_from_lookups(self, id, reviewed_by_f1000, citing_pmcids):
         metrics_dict = {}
-
-        reviewed_by_f1000 = self._check_reviewed_by_f1000(id, cache_enabled)
         if reviewed_by_f1000:
             metrics_dict["pubmed:f1000"] = reviewed_by_f1000
 
-        citing_pmcids = self._get_citing_pmcids(id, cache_enabled)
         if (citing_pmcids):
             metrics_dict["pubmed:pmc_citations"] = len(citing_pmcids)
+
+            # esearch only returns the matching ids, so it takes one query per
+            # publication type to count them separately
+            (review_pmids, editorial_pmids) = self.run_concurrently(
+                lambda: self._filter(id, citing_pmcids, "review"),
+                lambda: self._filter(id, citing_pmcids, "editorial"))
+            filtered_pmids_memo.set((id, "review"), review_pmids, default_settings.LOCAL_CACHE_MAX_AGE)
+            filtered_pmids_memo.set((id, "editorial"), editorial_pmids, default_settings.LOCAL_CACHE_MAX_AGE)
     
-            number_review_pmids = len(self._filter(id, citing_pmcids, "review"))
+            number_review_pmids = len(review_pmids)
             if number_review_pmids:
                 metrics_dict["pubmed:pmc_citations_reviews"] = number_review_pmids
     
-            number_editorial_pmids = len(self._filter(id, citing_pmcids, "editorial"))
+            number_editorial_pmids = len(editorial_pmids)
             if number_editorial_pmids:
                 metrics_dict["pubmed:pmc_citations_editorials"] = number_editorial_pmids
-        # check for f1000
 
         return metrics_dict
 
+    # override because multiple pages to get
+    def get_metrics_for_id(self, 
+            id, 
+            provider_url_template=None, 
+            cache_enabled=True):
+
+        logger.debug("%20s getting metrics for %s" % (self.provider_name, id))
+
+        # the f1000 check and the citations lookup are independent of each other
+        (reviewed_by_f1000, citing_pmcids) = self.run_concurrently(
+            lambda: self._check_reviewed_by_f1000(id, cache_enabled),
+            lambda: self._get_citing_pmcids(id, cache_enabled))
+        metrics_dict = self._metrics_from_lookups(id, reviewed_by_f1000, citing_pmcids)
+
+        return metrics_dict
+
+    # the f1000 and citing pmcids lookups are done once for all the ids, 
+    # the review and editorial filters are still done per id
+    def _get_metrics_for_ids(self, 
+            ids, 
+            provider_url_template=None, 
+            cache_enabled=True):
+
+        logger.debug("%20s getting metrics for %i ids" % (self.provider_name, len(ids)))
+        ids_string = ",".join(ids)
+
+        metrics_f1000_url = self.metrics_f1000_url_template %ids_string
+        pmc_citations_url = self.metrics_pmc_citations_url_template %ids_string
+        (f1000_page, citing_page) = self.run_concurrently(
+            lambda: self._get_eutils_page(ids_string, metrics_f1000_url, cache_enabled),
+            lambda: self._get_eutils_page(ids_string, pmc_citations_url, cache_enabled))
+        citing_pmcids_by_pmid = self._extract_citing_pmcids_by_pmid(citing_page)
+
+        metrics_by_id = {}
+        for id in ids:
+            reviewed_by_f1000 = self._extract_reviewed_by_f1000(f1000_page, id)
+            citing_pmcids = citing_pmcids_by_pmid.get(id, [])
+            metrics_by_id[id] = self._metrics_from_lookups(id, reviewed_by_f1000, citing_pmcids)
+        return metrics_by_id
+
     def _extract_citing_pmcids(self, page):
         if (not "PubMedToPMCcitingformSET" in page):
             raise ProviderContentMalformedError()
@@ -234,6 +391,21 @@ class Pubmed(Provider):
             pmcids = []
         return pmcids
 
+    # a page for several pmids has one REFORM element per pmid
+    def _extract_citing_pmcids_by_pmid(self, page):
+        if (not "PubMedToPMCcitingformSET" in page):
+            raise ProviderContentMalformedError()
+        (doc, lookup_function) = provider._get_doc_from_xml(page)
+        pmcids_by_pmid = {}
+        try:
+            for reform_dom in doc.getElementsByTagName("REFORM"):
+                pmid = reform_dom.getElementsByTagName("PMID")[0].firstChild.data
+                pmcid_doms = reform_dom.getElementsByTagName("PMCID")
+                pmcids_by_pmid[pmid] = [pmcid_dom.firstChild.data for pmcid_dom in pmcid_doms]
+        except (IndexError, AttributeError, TypeError):
+            logger.warning("%20s unexpected REFORM xml in citing pmcids page" % (self.provider_name))            
+        return pmcids_by_pmid
+
     # documentation for pubmedtopmcciting: http://www.pubmedcentral.nih.gov/utils/entrez2pmcciting.cgi
     # could take multiple PMC IDs
     def _get_citing_pmcids(self, id, cache_enabled=True):
@@ -257,20 +429,23 @@ class Pubmed(Provider):
             url = self._get_templated_url(self.provenance_url_f1000_template, id, "provenance")
 
         elif (metric_name == "pubmed:pmc_citations_reviews"):
-            citing_pmcids = self._get_citing_pmcids(id)
-            filtered_pmids = self._filter(id, citing_pmcids, "review")
+            filtered_pmids = self._get_filtered_pmids(id, "review")
             pmids_string = " OR ".join([pmid for pmid in filtered_pmids])
             url = self._get_templated_url(self.provenance_url_pmc_citations_filtered_template, 
                     urllib.quote(pmids_string), "provenance")
 
         elif (metric_name == "pubmed:pmc_citations_editorials"):
-            citing_pmcids = self._get_citing_pmcids(id)
-            filtered_pmids = self._filter(id,citing_pmcids, "editorial")
+            filtered_pmids = self._get_filtered_pmids(id, "editorial")
             pmids_string = " OR ".join([pmid for pmid in filtered_pmids])
             url = self._get_templated_url(self.provenance_url_pmc_citations_filtered_template, 
                     urllib.quote(pmids_string), "provenance")
 
         return url
 
-
-
+    # uses what the metrics lookup just found when it can, otherwise looks it up again
+    def _get_filtered_pmids(self, id, filter_ptype):
+        filtered_pmids = filtered_pmids_memo.get((id, filter_ptype))
+        if filtered_pmids is None:
+            citing_pmcids = self._get_citing_pmcids(id)
+            filtered_pmids = self._filter(id, citing_pmcids, filter_ptype)
+        return filtered_pmids
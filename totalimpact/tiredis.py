@@ -1,4 +1,6 @@
-import redis, logging, json
+import redis, logging, json, time, random
+
+from totalimpact import default_settings
 
 
 logger = logging.getLogger("ti.tiredis")
@@ -14,10 +16,28 @@ def decr_num_providers_left(self, item_id, provider_name):
         provider_name, item_id, num_providers_left))
     return int(num_providers_left)
 
-def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[]):
-    queue_string = json.dumps([tiid, aliases_dict, aliases_already_run])
-    logger.debug("adding item to queue ******* " + queue_string)
-    self.lpush("aliasqueue", queue_string)
+def alias_queue_key(priority):
+    return "aliasqueue:"+priority
+
+def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[], 
+        priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+    queue_string = json.dumps([tiid, aliases_dict, aliases_already_run, priority, tenant])
+    logger.debug("adding item to {priority} queue ******* ".format(
+        priority=priority) + queue_string)
+    self.lpush(alias_queue_key(priority), queue_string)
+
+def add_many_to_alias_queue(self, tiids_and_aliases_dicts, aliases_already_run=[], 
+        priority=default_settings.DEFAULT_QUEUE_PRIORITY, tenant=None):
+    # one pipelined round trip for all the items
+    logger.debug("adding {num} items to {priority} queue *******".format(
+        num=len(tiids_and_aliases_dicts), priority=priority))
+    if not tiids_and_aliases_dicts:
+        return
+    pipe = self.pipeline(transaction=False)
+    for (tiid, aliases_dict) in tiids_and_aliases_dicts:
+        pipe.lpush(alias_queue_key(priority), 
+            json.dumps([tiid, aliases_dict, aliases_already_run, priority, tenant]))
+    pipe.execute()
 
 def set_value(self, key, value, time_to_expire):
     json_value = json.dumps(value)
@@ -41,6 +61,20 @@ def set_num_providers_left(self, item_id, num_providers_left):
     expire = 60*60*24  # for a day    
     self.set_value(key, num_providers_left, expire)
 
+def set_num_providers_left_many(self, item_ids, num_providers_left):
+    # one pipelined round trip for all the items
+    logger.debug("setting {num} providers left to update for {num_items} items.".format(
+        num=num_providers_left,
+        num_items=len(item_ids)
+    ))
+    if not item_ids:
+        return
+    expire = 60*60*24  # for a day    
+    pipe = self.pipeline(transaction=False)
+    for item_id in item_ids:
+        pipe.setex("num_providers_left:"+item_id, json.dumps(num_providers_left), expire)
+    pipe.execute()
+
 def get_num_providers_left(self, item_id):
     key = "num_providers_left:"+item_id
     r = self.get_value(key)
@@ -49,6 +83,25 @@ def get_num_providers_left(self, item_id):
     else:
         return int(r)
 
+def get_num_providers_left_many(self, item_ids):
+    # one MGET for all the items; None for items not in redis
+    if not item_ids:
+        return []
+    keys = ["num_providers_left:"+item_id for item_id in item_ids]
+    response = []
+    for json_value in self.mget(keys):
+        try:
+            response.append(int(json.loads(json_value)))
+        except TypeError:
+            response.append(None)
+    return response
+
+def get_currently_updating_many(self, item_ids):
+    # an item is updating while it has providers left; items not in redis, maybe
+    # because their count expired, are assumed not to be
+    return [bool(num_providers_left) and (num_providers_left > 0)
+        for num_providers_left in self.get_num_providers_left_many(item_ids)]
+
 def set_memberitems_status(self, memberitems_key, query_status):
     key = "memberitems:"+memberitems_key 
     expire = 60*60*24  # for a day    
@@ -95,12 +148,106 @@ def get_reference_lookup_dict(self, genre, refset_name, year):
     value = self.get_value(key)
     return value
 
+PROVIDER_HEALTH_MAX_AGE = 60*60  # an hour
+
+def set_provider_health(self, provider_name, process_name, health):
+    # each backend process has its own breaker and limit, so each gets its own entry
+    key = "provider_health_by_process:"+provider_name
+    pipe = self.pipeline(transaction=False)
+    pipe.hset(key, process_name, json.dumps(health))
+    pipe.expire(key, PROVIDER_HEALTH_MAX_AGE)
+    pipe.execute()
+
+def get_provider_health(self, provider_name):
+    """ Returns {process_name: health} for the processes that have published lately, or None """
+    key = "provider_health_by_process:"+provider_name
+    health_by_process = {}
+    for (process_name, health_json) in self.hgetall(key).items():
+        health = json.loads(health_json)
+        # leave out processes that have gone away
+        if time.time() - health.get("published_at", 0) < PROVIDER_HEALTH_MAX_AGE:
+            health_by_process[process_name] = health
+    return health_by_process or None
+
+# set once we've found the redis server is too old for TIME
+server_time_unavailable = False
+
+def server_time(self):
+    """ Seconds since the epoch by the redis server's clock.
+
+    TIME needs redis 2.6; on older servers this warns once and uses 
+    this host's clock from then on.
+    """
+    global server_time_unavailable
+    if not server_time_unavailable:
+        try:
+            (seconds, microseconds) = self.execute_command("TIME")
+            return int(seconds) + (int(microseconds) / 1000000.0)
+        except redis.ResponseError, e:
+            server_time_unavailable = True
+            logger.warning("redis has no TIME command, rate limiting by local clocks instead: %s" % (
+                e.__repr__()))
+    return time.time()
+
+# how many times to retry a token take that raced with someone else's, 
+# and the base for the jittered sleep between tries
+RATE_LIMIT_MAX_WATCH_RETRIES = 10
+RATE_LIMIT_WATCH_BACKOFF = 0.01  # seconds
+
+def take_rate_limit_token(self, bucket_name, rate, burst):
+    """ Token bucket shared by everything using this redis.
+
+    Refills by the redis server's clock, so hosts whose clocks disagree 
+    still share the bucket evenly.
+
+    Takes a token if one is available and returns 0, otherwise returns 
+    how many seconds until the next token will be available.  If the 
+    bucket is too contended to update, returns a short wait instead of 
+    spinning on it.
+    """
+    key = "rate_limit:"+bucket_name
+    pipe = self.pipeline()
+    try:
+        for retry in range(RATE_LIMIT_MAX_WATCH_RETRIES):
+            try:
+                pipe.watch(key)
+                bucket = pipe.hgetall(key)
+                now = server_time(pipe)
+                tokens = float(bucket.get("tokens", burst))
+                last_updated = float(bucket.get("last_updated", now))
+                # never negative, in case the clock has gone back
+                tokens = min(burst, tokens + max(0, now - last_updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait_seconds = 0
+                else:
+                    wait_seconds = (1 - tokens) / rate
+                pipe.multi()
+                # repr, since str would round the time to a hundredth of a second
+                pipe.hmset(key, {"tokens": repr(tokens), "last_updated": repr(now)})
+                pipe.expire(key, int(burst / rate) + 60)
+                pipe.execute()
+                return wait_seconds
+            except redis.WatchError:
+                # someone else took a token in the meantime; back off, then try again
+                pipe.reset()
+                time.sleep(random.uniform(0, RATE_LIMIT_WATCH_BACKOFF * 2**retry))
+    finally:
+        pipe.reset()
+    logger.warning("gave up taking a %s rate limit token after %i tries" % (
+        bucket_name, RATE_LIMIT_MAX_WATCH_RETRIES))
+    return random.uniform(0.5, 1.5) / rate
+
 redis.Redis.set_value = set_value
 redis.Redis.get_value = get_value
 redis.Redis.set_num_providers_left = set_num_providers_left
 redis.Redis.get_num_providers_left = get_num_providers_left
+redis.Redis.set_num_providers_left_many = set_num_providers_left_many
+redis.Redis.get_num_providers_left_many = get_num_providers_left_many
+redis.Redis.get_currently_updating_many = get_currently_updating_many
 redis.Redis.decr_num_providers_left = decr_num_providers_left
 redis.Redis.add_to_alias_queue = add_to_alias_queue
+redis.Redis.add_many_to_alias_queue = add_many_to_alias_queue
 redis.Redis.set_memberitems_status = set_memberitems_status
 redis.Redis.get_memberitems_status = get_memberitems_status
 redis.Redis.set_confidence_interval_table = set_confidence_interval_table
@@ -109,6 +256,10 @@ redis.Redis.set_reference_histogram_dict = set_reference_histogram_dict
 redis.Redis.get_reference_histogram_dict = get_reference_histogram_dict
 redis.Redis.set_reference_lookup_dict = set_reference_lookup_dict
 redis.Redis.get_reference_lookup_dict = get_reference_lookup_dict
+redis.Redis.set_provider_health = set_provider_health
+redis.Redis.get_provider_health = get_provider_health
+redis.Redis.server_time = server_time
+redis.Redis.take_rate_limit_token = take_rate_limit_token
 
 
 
@@ -1,17 +1,20 @@
 import time
 import logging
+import os
+import socket
 
 logger = logging.getLogger('ti.utils')
 
 class Retry(object):
     default_exceptions = (Exception,)
-    def __init__(self, tries, exceptions=None, delay=0):
+    def __init__(self, tries, exceptions=None, delay=0, reraise=False):
         """
         Decorator for retrying a function if exception occurs
 
         tries -- num tries
         exceptions -- exceptions to catch
         delay -- wait between retries
+        reraise -- raise the last exception after the last try, instead of returning False
         from http://peter-hoffmann.com/2010/retry-decorator-python.html
         """
         self.tries = tries
@@ -19,6 +22,7 @@ class Retry(object):
             exceptions = Retry.default_exceptions
         self.exceptions =  exceptions
         self.delay = delay
+        self.reraise = reraise
 
     def __call__(self, f):
         def fn(*args, **kwargs):
@@ -31,13 +35,13 @@ class Retry(object):
                     time.sleep(self.delay)
                     exception = e
 
-            #if no success after tries, could raise last exception here...
-
             logger.debug("Tried mightily, but giving up after {tries} '{exception_type}' exceptions.".format(
                 tries=self.tries,
                 exception_type=e.__repr__()
             ))
 
+            if self.reraise:
+                raise exception
             return False # fail silently...
         return fn
 
@@ -49,3 +53,43 @@ def to_unicode_or_bust(obj, encoding='utf-8'):
              obj = unicode(obj, encoding)
      return obj
 
+
+
+class FrozenDict(dict):
+    """ A dict that can't be changed after it is made, so it can be shared without copying """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict can't be changed")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def freeze(value):
+    # dicts to FrozenDicts and lists to tuples, all the way down
+    if isinstance(value, dict):
+        if isinstance(value, FrozenDict):
+            return value
+        return FrozenDict([(k, freeze(v)) for (k, v) in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(v) for v in value])
+    return value
+
+def thaw(value):
+    # a plain, changeable deep copy of a frozen (or plain) value
+    if isinstance(value, dict):
+        return dict([(k, thaw(v)) for (k, v) in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+def process_name():
+    # tells apart the backend processes sharing one redis, on one host or several
+    return "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
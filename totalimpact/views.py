@@ -120,6 +120,16 @@ def tiid(ns, nid):
     return resp
 
 
+def queue_tenant(cid=None):
+    # who the provider queues charge this work to when taking turns
+    if cid:
+        return "collection:"+cid
+    key = request.values.get("key", None)
+    if key:
+        return "key:"+key
+    return None
+
+
 def create_item(namespace, nid):
     logger.debug("In create_item with alias" + str((namespace, nid)))
     item = ItemFactory.make()
@@ -133,7 +143,9 @@ def create_item(namespace, nid):
     item["aliases"][namespace] = [nid]
     mydao.save(item)
 
-    myredis.add_to_alias_queue(item["_id"], item["aliases"])
+    # someone is waiting on this one, so it goes ahead of any bulk updates
+    myredis.add_to_alias_queue(item["_id"], item["aliases"], 
+        priority="interactive", tenant=queue_tenant())
 
     logger.info("Created new item '{id}' with alias '{alias}'".format(
         id=item["_id"],
@@ -170,7 +182,7 @@ def create_or_find_items_from_aliases(clean_aliases):
     return(tiids, items)
 
 
-def prep_collection_items(aliases):
+def prep_collection_items(aliases, cid=None):
     logger.info("got a list of aliases; creating new items for them.")
     try:
         # remove unprintable characters and change list to tuples
@@ -199,13 +211,13 @@ def prep_collection_items(aliases):
 
     # for each item, set the number of providers that need to run before the update is done
     # and put them on the update queue
-    for item in items:
-        myredis.set_num_providers_left(
-            item["_id"],
-            ProviderFactory.num_providers_with_metrics(
-                default_settings.PROVIDERS)
-        )
-        myredis.add_to_alias_queue(item["_id"], item["aliases"])
+    myredis.set_num_providers_left_many(
+        [item["_id"] for item in items],
+        ProviderFactory.num_providers_with_metrics(
+            default_settings.PROVIDERS)
+    )
+    myredis.add_many_to_alias_queue([(item["_id"], item["aliases"]) for item in items], 
+        priority="collection-create", tenant=queue_tenant(cid))
 
     return tiids
 
@@ -332,6 +344,22 @@ def provider_memberitems(provider_name):
     return resp
 
 
+# for internal use only
+@app.route('/provider/health', methods=['GET'])
+def provider_health():
+    """
+    Circuit breaker state and concurrency limit for each provider, as last 
+    published by each backend process, keyed by process.  null for providers 
+    the backend hasn't reported on.
+    """
+    ret = {}
+    for (provider_name, provider_config) in default_settings.PROVIDERS:
+        ret[provider_name] = myredis.get_provider_health(provider_name)
+    resp = make_response(json.dumps(ret, sort_keys=True, indent=4), 200)
+    resp.mimetype = "application/json"
+    return resp
+
+
 """
 Gets aliases associated with a query from a given provider.
 
@@ -467,23 +495,33 @@ def collection_update(cid=""):
         abort(404, "couldn't get tiids for this collection...maybe doesn't exist?")
 
     # put each of them on the update queue
+    try:
+        item_docs = mydao.get_many(tiids)
+    except Exception:
+        logger.exception("couldn't get items for collection '{cid}'".format(
+            cid=cid
+        ))
+        abort(503, "couldn't get the items for this collection, try again later")
+    tiids_and_aliases_dicts = []
     for tiid in tiids:
         logger.debug("In update_item with tiid " + tiid)
-
-        # set this so we know when it's still updating later on
-        myredis.set_num_providers_left(
-            tiid,
-            ProviderFactory.num_providers_with_metrics(default_settings.PROVIDERS)
-        )
-
-        item_doc = mydao.get(tiid)
+        item_doc = item_docs.get(tiid)
         try:
-            myredis.add_to_alias_queue(item_doc["_id"], item_doc["aliases"])
+            tiids_and_aliases_dicts.append((item_doc["_id"], item_doc["aliases"]))
         except (KeyError, TypeError):
             logger.debug("couldn't get item_doc for {tiid}. Skipping its update".format(
                 tiid=tiid))
             pass
 
+    # set this so we know when they are still updating later on.  Only for 
+    # the items we're queueing, or the rest would look like they never finish.
+    myredis.set_num_providers_left_many(
+        [tiid for (tiid, aliases_dict) in tiids_and_aliases_dicts],
+        ProviderFactory.num_providers_with_metrics(default_settings.PROVIDERS)
+    )
+    myredis.add_many_to_alias_queue(tiids_and_aliases_dicts, 
+        priority="scheduled-refresh", tenant=queue_tenant(cid))
+
 
     resp = make_response("true", 200)
     resp.mimetype = "application/json"
@@ -508,7 +546,7 @@ def collection_create():
     try:
         coll["title"] = request.json["title"]
         aliases = request.json["aliases"]
-        tiids = prep_collection_items(aliases)
+        tiids = prep_collection_items(aliases, coll["_id"])
         aliases_strings = [namespace+":"+nid for (namespace, nid) in aliases]
     except (AttributeError, TypeError):
         # we got missing or improperly formated data.